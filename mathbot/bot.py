@@ -17,6 +17,7 @@ from discord.ext.commands.errors import CommandNotFound, MissingRequiredArgument
 import core.blame
 import core.keystore
 import core.settings
+import core.web
 import utils
 
 from queuedict import QueueDict
@@ -59,7 +60,18 @@ class MathBot(PatronageMixin, discord.ext.commands.AutoShardedBot):
 		self.parameters = parameters
 		self.release = parameters.get('release')
 		self.keystore = _create_keystore(parameters)
-		self.settings = core.settings.Settings(self.keystore)
+		self.settings = core.settings.Settings(
+			self.keystore,
+			cache_ttl=parameters.get('settings cache ttl'),
+			cache_size=parameters.get('settings cache max-size'),
+			pubsub=parameters.get('settings cache pubsub')
+		)
+		self.web = core.web.WebClient(
+			limit=parameters.get('http limit'),
+			limit_per_host=parameters.get('http limit-per-host'),
+			keepalive_timeout=parameters.get('http keepalive-timeout'),
+			dns_cache_ttl=parameters.get('http dns-cache-ttl')
+		)
 		self.command_output_map = QueueDict(timeout = 60 * 10) # 10 minute timeout
 		self.blocked_users = parameters.get('blocked-users')
 		self.closing_due_to_indeterminite_prefix = False
@@ -69,6 +81,16 @@ class MathBot(PatronageMixin, discord.ext.commands.AutoShardedBot):
 	def run(self):
 		super().run(self.parameters.get('token'))
 
+	async def setup_hook(self):
+		await self.keystore.start()
+		await self.settings.listen_for_invalidations()
+
+	async def close(self):
+		await super().close()
+		await self.settings.close()
+		await self.keystore.close()
+		await self.web.close()
+
 	async def on_shard_ready(self, shard_id):
 		print('on_shard_ready', shard_id)
 
@@ -245,6 +267,7 @@ def _get_extensions(parameters):
 	yield 'modules.wolfram'
 	yield 'modules.oeis'
 	yield 'modules.reboot'
+	yield 'modules.stats'
 	if parameters.get('release') == 'development':
 		yield 'modules.echo'
 		yield 'modules.throws'
@@ -256,7 +279,12 @@ def _create_keystore(parameters):
 	if keystore_mode == 'redis':
 		return core.keystore.create_redis(
 			parameters.get('keystore redis url'),
-			parameters.get('keystore redis number')
+			parameters.get('keystore redis number'),
+			max_connections=parameters.get('keystore redis max-connections'),
+			socket_timeout=parameters.get('keystore redis socket-timeout'),
+			connect_timeout=parameters.get('keystore redis connect-timeout'),
+			retries=parameters.get('keystore redis retries'),
+			retry_backoff=parameters.get('keystore redis retry-backoff')
 		)
 	if keystore_mode == 'disk':
 		return core.keystore.create_disk(parameters.get('keystore disk filename'))
@@ -21,8 +21,8 @@ def calculate(equation, tick_limit=None, trace=False, use_runtime=True):
 	builder = calculator.bytecode.Builder()
 	# Setup the runtime
 	if use_runtime:
-		segment_runtime = runtime.prepare_runtime(builder)
-		interp.run(segment=segment_runtime)
+		for segment_runtime in calculator.runtime.prepare_runtime(builder):
+			interp.run(segment=segment_runtime)
 	# Run the actual program
 	_, ast = calculator.parser.parse(equation)
 	segment_program = builder.build(ast)
@@ -52,7 +52,6 @@ def run_file(filename):
 
 	terminal = Terminal.new_blackbox_sync(
 		allow_special_commands=False,
-		yield_rate=1,
 		trap_unknown_errors=False
 	)
 
@@ -65,7 +64,6 @@ def run_file(filename):
 def interactive_terminal():
 	terminal = Terminal.new_blackbox_sync(
 		allow_special_commands=True,
-		yield_rate=1,
 		trap_unknown_errors=True
 	)
 	while True:
@@ -0,0 +1,163 @@
+''' Benchmarks the calculator by running the programs in calculator/scripts.
+
+	python -m calculator.bench                      Run every script
+	python -m calculator.bench fib quicksort        Run some of them
+	python -m calculator.bench -o after.json        Save the results
+	python -m calculator.bench -c before.json       Compare against saved results
+
+	Each iteration runs the script in a new terminal, so compiling and
+	running the program are both included in the timings. Peak memory
+	is measured on a separate run, since tracing allocations slows
+	everything else down.
+'''
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import sympy
+
+import calculator.bytecode
+from calculator.blackbox import Terminal
+
+
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(__file__), 'scripts')
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(prog='python -m calculator.bench')
+	parser.add_argument('scripts', nargs='*', help='Names of the scripts to run (default: all of them)')
+	parser.add_argument('-n', '--iterations', type=int, default=5, help='Number of times to run each script')
+	parser.add_argument('-o', '--output', help='File to write the results to, as JSON')
+	parser.add_argument('-c', '--compare', help='Results from an earlier run to compare against')
+	return parser.parse_args()
+
+
+def find_scripts(names):
+	if not names:
+		return sorted(glob.glob(os.path.join(SCRIPT_DIRECTORY, '*.c5')))
+	return [
+		name if os.path.exists(name) else os.path.join(SCRIPT_DIRECTORY, name + '.c5')
+		for name in names
+	]
+
+
+async def run_once(code):
+	''' Runs some code in a new terminal and returns the terminal, the output, whether
+		it worked, and how long it took
+	'''
+	terminal = await Terminal.new_blackbox(allow_special_commands=False)
+	terminal.timeout = False
+	# Make sure every iteration compiles the code
+	calculator.bytecode.COMPILE_CACHE.clear()
+	start = time.perf_counter()
+	output, worked, _ = await terminal.execute_async(code)
+	return terminal, output, worked, time.perf_counter() - start
+
+
+async def bench_script(filename, iterations):
+	with open(filename) as f:
+		code = f.read()
+	times = []
+	ticks = 0
+	hits = 0
+	misses = 0
+	for _ in range(iterations):
+		terminal, output, worked, elapsed = await run_once(code)
+		if not worked:
+			return {
+				'worked': False,
+				'error': output.strip().split('\n')[0]
+			}
+		times.append(elapsed)
+		ticks += terminal.interpereter.ticks
+		hits += terminal.interpereter.calling_cache.hits
+		misses += terminal.interpereter.calling_cache.misses
+	tracemalloc.start()
+	try:
+		await run_once(code)
+		_, peak_memory = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return {
+		'worked': True,
+		'wall_time': {
+			'min': min(times),
+			'mean': sum(times) / len(times),
+			'max': max(times)
+		},
+		'ticks': ticks // iterations,
+		'ticks_per_second': ticks / sum(times),
+		'peak_memory': peak_memory,
+		'cache_hit_rate': hits / (hits + misses) if hits + misses else None
+	}
+
+
+def current_commit():
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', 'HEAD'],
+			cwd=os.path.dirname(__file__),
+			stderr=subprocess.DEVNULL
+		).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def print_result(name, result, previous):
+	if not result['worked']:
+		print(f'{name:24} failed: {result["error"]}')
+		return
+	line = '{:24} {:8.3f}s {:>12,.0f} ticks/s {:>8.1f} MiB'.format(
+		name,
+		result['wall_time']['min'],
+		result['ticks_per_second'],
+		result['peak_memory'] / 2 ** 20
+	)
+	if result['cache_hit_rate'] is not None:
+		line += '  cache hits {:5.1%}'.format(result['cache_hit_rate'])
+	if previous and previous.get('worked'):
+		line += '  ({:.2f}x)'.format(previous['wall_time']['min'] / result['wall_time']['min'])
+	print(line)
+
+
+async def run(arguments):
+	previous = {}
+	if arguments.compare:
+		with open(arguments.compare) as f:
+			previous = json.load(f)['scripts']
+	results = {
+		'commit': current_commit(),
+		'python': platform.python_version(),
+		'sympy': sympy.__version__,
+		'iterations': arguments.iterations,
+		'scripts': {}
+	}
+	for filename in find_scripts(arguments.scripts):
+		name = os.path.splitext(os.path.basename(filename))[0]
+		result = await bench_script(filename, arguments.iterations)
+		results['scripts'][name] = result
+		print_result(name, result, previous.get(name))
+	if arguments.output:
+		with open(arguments.output, 'w') as f:
+			json.dump(results, f, indent=4, sort_keys=True)
+	return results
+
+
+def main():
+	arguments = parse_arguments()
+	if arguments.iterations < 1:
+		print('There must be at least one iteration')
+		sys.exit(1)
+	asyncio.run(run(arguments))
+
+
+if __name__ == '__main__':
+	main()
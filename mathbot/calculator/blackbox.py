@@ -3,15 +3,18 @@ import calculator.interpereter
 import calculator.parser
 import calculator.runtime
 import calculator.bytecode
+import calculator.bytecode_cache
 import calculator.errors
 import calculator.runtime
 import calculator.formatter
 import calculator.crucible
+import calculator.snapshot
 import sympy
 import async_timeout
 import json
 import traceback
 import re
+import sys
 from time import time
 
 
@@ -35,21 +38,34 @@ class Terminal:
                  colour_output=False,
                  runtime_protection_level=0,
                  _called_directly=True,
-                 trap_unknown_errors=False):
+                 trap_unknown_errors=False,
+                 cache_capacity=10000,
+                 cache_byte_budget=None,
+                 cache_item_size_limit=None):
         if _called_directly:
             raise Exception('You should not be calling Terminal.__init__ directly.')
         self.show_tree = False
         self.show_parsepoint = False
         self.show_result_type = False
         self.builder = calculator.bytecode.Builder()
+        self.last_segment = None
         self.allow_special_commands = allow_special_commands
         self.colour_output = colour_output
-        self.interpereter = calculator.interpereter.Interpereter(yield_rate=yield_rate, use_crucible=True)
+        self.interpereter = calculator.interpereter.Interpereter(
+            yield_rate=yield_rate,
+            use_crucible=True,
+            cache_capacity=cache_capacity,
+            cache_byte_budget=cache_byte_budget,
+            cache_item_size_limit=cache_item_size_limit
+        )
         self.line_count = 0
         self.retain_cache = retain_cache
         self.output_limit = output_limit
         self.trap_unknown_errors = False
         self.timeout = True
+        # Number of root scope slots that came from the runtime template
+        self.runtime_size = 0
+        self.runtime_template = None
 
     @staticmethod
     def new_blackbox_sync(**kwargs):
@@ -59,33 +75,24 @@ class Terminal:
     @staticmethod
     async def new_blackbox(**kwargs):
         term = Terminal(_called_directly=False, **kwargs)
-        try:
-            runtime_segment = calculator.runtime.prepare_runtime(term.builder)
-        except calculator.parser.ParseFailed as e:
-            print('RUNTIME ISSUE: Parse error')
-            print(format_error_place(calculator.runtime.LIBRARY_CODE, e.position))
-            raise e
-        except calculator.parser.TokenizationFailed as e:
-            print('RUNTIME ISSUE: Tokenization error')
-            print(format_error_place(calculator.runtime.LIBRARY_CODE, e.position))
-            raise e
-        try:
-            await term.interpereter.run_async(
-                segment=runtime_segment,
-                assignment_auth_level=kwargs.get('runtime_protection_level', 0),
-                assignment_protection_level=kwargs.get('runtime_protection_level', 0)
-            )
-        except Exception:
-            print('Error during library loading. Re-running with trace.')
-            traceback.print_exc()
-            temp_interp = calculator.interpereter.Interpereter(
-                term.linker.constructed(),
-                yield_rate=kwargs.get('yield_rate', 100),
-                trace=True
-            )
-            await temp_interp.run_async()
+        template = await RuntimeTemplate.get(kwargs.get('runtime_protection_level', 0))
+        template.apply(term)
         return term
 
+    def estimate_size(self):
+        ''' Roughly estimates how much memory the terminal uses, in bytes.
+            Values shared with the runtime template aren't counted, and
+            code that several functions share is only counted once.
+        '''
+        values = self.interpereter.root_scope.values
+        size = sys.getsizeof(values) + self.interpereter.calling_cache.total_size
+        seen = set()
+        if self.runtime_template is not None:
+            seen.update(calculator.snapshot.shared_objects(self.runtime_template)[0])
+        for value in values[self.runtime_size:]:
+            if value is not None:
+                size += calculator.interpereter.estimate_size(value, seen=seen)
+        return size
 
     def execute(self, code):
         loop = asyncio.get_event_loop()
@@ -93,13 +100,17 @@ class Terminal:
         return loop.run_until_complete(future)
 
     async def execute_async(self, code, **kwargs):
-        return await self.execute_internal(code)
+        return await self.execute_internal(code, **kwargs)
 
-    async def execute_internal(self, line, **kwargs):
+    async def execute_internal(self, line, source_name=None, cache_bytecode=False, **kwargs):
         ''' Runs some code.
             Returns a string-bool tuple.
             The string is the output to display to the user.
             The bool is True if nothing went wrong.
+            If cache_bytecode is True, the compiled code is kept in memory and
+            reused when any terminal runs the same code (useful for libraries).
+            Only the system library is stored on disk, since the code
+            that's run here may come from users.
         '''
         output = []
         details = {}
@@ -122,9 +133,9 @@ class Terminal:
         elif self.allow_special_commands and line == ':type':
             self.show_result_type = not self.show_result_type
         elif self.allow_special_commands and line == ':dump':
-            c = self.linker.constructed()
-            for byte, elnk in zip(c.bytecode, c.error_link):
-                print(byte, elnk)
+            if self.last_segment is not None:
+                for place, inst, operands in self.last_segment.instructions():
+                    prt('{:4d} {} {}'.format(place, inst.name, ' '.join(map(repr, operands))))
         elif self.allow_special_commands and line == ':cache':
             for key, value in self.interpereter.calling_cache.values.items():
                 prt('{:40} : {:20}'.format(str(key), str(value)))
@@ -150,12 +161,20 @@ class Terminal:
         else:
             try:
                 worked = False
-                tokens, ast = calculator.parser.parse(line, source_name = 'iterm_' + str(self.line_count))
-                if self.show_tree:
-                    prt(json.dumps(ast, indent = 4))
-                ast = {'#': 'program', 'items': [ast, {'#': 'end'}]}
+                if source_name is None:
+                    source_name = 'iterm_' + str(self.line_count)
+                if cache_bytecode:
+                    code_segment = calculator.bytecode_cache.compile_cached(self.builder, line, source_name, directory=None)
+                elif not self.show_tree:
+                    code_segment = calculator.bytecode.COMPILE_CACHE.compile(self.builder, line, source_name)
+                else:
+                    tokens, ast = calculator.parser.parse(line, source_name = source_name)
+                    if self.show_tree:
+                        prt(json.dumps(ast, indent = 4, default = calculator.parser.Token.as_dict))
+                    ast = {'#': 'program', 'items': [ast, {'#': 'end'}]}
+                    code_segment = self.builder.build(ast)
                 self.interpereter.stack = [None]
-                code_segment = self.builder.build(ast)
+                self.last_segment = code_segment
                 # for index, byte in enumerate(bytes):
                 #   print('{:3d} - {}'.format(index, byte))
 
@@ -168,27 +187,39 @@ class Terminal:
                 details['result'] = result_items
                 worked = True
                 for result in result_items:
-                    if isinstance(result, tuple(sympy.core.core.all_classes)):
-                        f_res = await calculator.crucible.run(
-                            calculator.formatter.format,
-                            (result,),
-                            timeout = 2 if self.timeout else 10 ** 10
-                        )
+                    timeout = 2 if self.timeout else 10 ** 10
+                    is_sympy = isinstance(result, tuple(sympy.core.core.all_classes))
+                    has_evalf = hasattr(result, 'evalf')
+                    # Formatting and evaluating the result happen in a single
+                    # trip to the crucible, so the result is only sent once
+                    jobs = []
+                    if is_sympy:
+                        jobs.append((calculator.formatter.format, (result,), timeout))
+                    if has_evalf:
+                        jobs.append((result.evalf, (), timeout))
+                    # If formatting times out the result can't be shown, so
+                    # there's no point waiting for evalf in another process
+                    outcomes = await calculator.crucible.run_batch(jobs, abandon_on_failure=True)
+                    if is_sympy:
+                        f_res = outcomes[0].get()
                     else:
                         f_res = calculator.formatter.format(result, limit=self.output_limit)
-                    try:
-                        exact = await calculator.crucible.run(result.evalf, (), timeout= 2 if self.timeout else 10 ** 10)
-                        details['exact'] = exact
-                        f_ext = calculator.formatter.format(exact, limit=self.output_limit)
-                        f_ext = re.sub(r'\d+\.\d+', lambda x: x.group(0).rstrip('0').rstrip('.'), f_ext)
-                        f_ext = calculator.formatter.sympy_cleanup(f_ext)
-                        if f_ext in ['inf', '-inf', f_res.replace('\N{SINGLE LOW-9 QUOTATION MARK}', '')]:
-                            raise Exception
-                        prt(f_res, '=', f_ext)
-                    except asyncio.TimeoutError:
-                        prt(f_res, '[exact value timed out]')
-                    except Exception as e:
+                    if not has_evalf:
                         prt(f_res)
+                    else:
+                        try:
+                            exact = outcomes[-1].get()
+                            details['exact'] = exact
+                            f_ext = calculator.formatter.format(exact, limit=self.output_limit)
+                            f_ext = re.sub(r'\d+\.\d+', lambda x: x.group(0).rstrip('0').rstrip('.'), f_ext)
+                            f_ext = calculator.formatter.sympy_cleanup(f_ext)
+                            if f_ext in ['inf', '-inf', f_res.replace('\N{SINGLE LOW-9 QUOTATION MARK}', '')]:
+                                raise Exception
+                            prt(f_res, '=', f_ext)
+                        except asyncio.TimeoutError:
+                            prt(f_res, '[exact value timed out]')
+                        except Exception as e:
+                            prt(f_res)
                     if self.show_result_type:
                         prt(result.__class__)
                         prt(result.__class__.__mro__)
@@ -217,6 +248,8 @@ class Terminal:
                 prt('Output was too large to display')
             except asyncio.TimeoutError:
                 prt('Operation timed out')
+            except calculator.crucible.MemoryLimitExceeded:
+                prt('Operation ran out of memory')
             except Exception:
                 if not self.trap_unknown_errors:
                     raise
@@ -227,6 +260,68 @@ class Terminal:
         return '\n'.join(output), worked, details
 
 
+class RuntimeTemplate:
+
+    ''' The state of a terminal after the standard runtime has been loaded.
+        This is built once per process (for each protection level) and
+        then copied into every new terminal, so that the library doesn't
+        need to be compiled and run again each time.
+    '''
+
+    _templates = {}
+
+    def __init__(self, builder, root_scope):
+        self.builder = builder
+        self.root_scope = root_scope
+
+    @staticmethod
+    async def get(runtime_protection_level=0):
+        template = RuntimeTemplate._templates.get(runtime_protection_level)
+        if template is None:
+            template = await RuntimeTemplate.build(runtime_protection_level)
+            template = RuntimeTemplate._templates.setdefault(runtime_protection_level, template)
+        return template
+
+    @staticmethod
+    async def build(runtime_protection_level=0):
+        builder = calculator.bytecode.Builder()
+        interpereter = calculator.interpereter.Interpereter()
+        try:
+            runtime_segments = calculator.runtime.prepare_runtime(builder)
+        except calculator.parser.ParseFailed as e:
+            print('RUNTIME ISSUE: Parse error')
+            print(format_error_place(calculator.runtime.LIBRARY_CODE, e.position))
+            raise e
+        except calculator.parser.TokenizationFailed as e:
+            print('RUNTIME ISSUE: Tokenization error')
+            print(format_error_place(calculator.runtime.LIBRARY_CODE, e.position))
+            raise e
+        for runtime_segment in runtime_segments:
+            try:
+                await interpereter.run_async(
+                    segment=runtime_segment,
+                    assignment_auth_level=runtime_protection_level,
+                    assignment_protection_level=runtime_protection_level
+                )
+            except Exception:
+                print('Error during library loading. Re-running with trace.')
+                traceback.print_exc()
+                temp_interp = calculator.interpereter.Interpereter(trace=True)
+                temp_interp.root_scope = interpereter.root_scope.copy()
+                temp_interp.current_scope = temp_interp.root_scope
+                await temp_interp.run_async(segment=runtime_segment)
+                raise
+        return RuntimeTemplate(builder, interpereter.root_scope)
+
+    def apply(self, term):
+        ''' Give a terminal its own copy of the runtime '''
+        term.builder = self.builder.copy()
+        term.interpereter.root_scope = self.root_scope.copy()
+        term.interpereter.current_scope = term.interpereter.root_scope
+        term.runtime_size = len(self.root_scope.values)
+        term.runtime_template = self
+
+
 def handle_eval_error(prt, e):
     dbg = e._linking
     if dbg is None:
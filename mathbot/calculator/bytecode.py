@@ -1,4 +1,7 @@
 import enum
+import array
+import hashlib
+import collections
 import calculator.parser as parser
 import calculator.errors
 import calculator.functions
@@ -82,7 +85,10 @@ class I(enum.IntEnum):
 	CONSTANT_STRING = 67
 	CONSTANT_GLYPH = 68
 
-	# Next to use: 70
+	# Marks the start of a function definition. Never executed.
+	FUNCTION_HEADER = 70
+
+	# Next to use: 71
 
 
 OPERATOR_DICT = {
@@ -123,6 +129,44 @@ COMPARATOR_DICT = {
 }
 
 
+class Operand(enum.Enum):
+	''' The kinds of data that can follow an instruction in compiled code. '''
+	INLINE = 0   # Small integer, stored directly in the code
+	GLOBAL = 1   # Index of a global variable, stored directly in the code
+	CONSTANT = 2 # Index into the segment's constant pool
+	LABEL = 3    # Address in the same segment, stored directly in the code
+	SEGMENT = 4  # Index of a (segment, address) pair in the constant pool
+
+
+OPERANDS = {
+	I.CONSTANT: (Operand.CONSTANT,),
+	I.CONSTANT_STRING: (Operand.CONSTANT,),
+	I.CONSTANT_GLYPH: (Operand.CONSTANT,),
+	I.WORD: (Operand.CONSTANT,),
+	I.JUMP_IF_MACRO: (Operand.LABEL,),
+	I.JUMP: (Operand.LABEL,),
+	I.JUMP_IF_TRUE: (Operand.LABEL,),
+	I.JUMP_IF_FALSE: (Operand.LABEL,),
+	I.ARG_LIST_END: (Operand.INLINE,),
+	I.ARG_LIST_END_NO_CACHE: (Operand.INLINE,),
+	I.ARG_LIST_END_WITH_TCO: (Operand.INLINE,),
+	I.ASSIGNMENT: (Operand.GLOBAL,),
+	I.UNLOAD: (Operand.GLOBAL,),
+	I.DECLARE_SYMBOL: (Operand.GLOBAL, Operand.CONSTANT),
+	I.ACCESS_GLOBAL: (Operand.GLOBAL, Operand.CONSTANT),
+	I.ACCESS_LOCAL: (Operand.INLINE,),
+	I.ACCESS_SEMI: (Operand.INLINE, Operand.INLINE),
+	I.FUNCTION_NORMAL: (Operand.SEGMENT,),
+	I.PUSH_ERROR_STOPGAP: (Operand.LABEL, Operand.INLINE),
+	# name, number of parameters, is variadic, is macro
+	I.FUNCTION_HEADER: (Operand.CONSTANT, Operand.INLINE, Operand.INLINE, Operand.INLINE),
+}
+
+
+# Type of the array that compiled code is stored in
+CODE_TYPECODE = 'I'
+
+
 PROTECTED_NAMES = [
 	'if',
 	'ifelse',
@@ -195,18 +239,40 @@ class ConstructionContext:
 
 class ConstructedBytecode:
 
-	def __init__(self, segment):
-		self.bytecode = segment.bytecode
-		self.error_link = segment.error_link
+	''' A segment of compiled code.
 
-	def __getitem__(self, index):
-		return self.bytecode[index]
+		code       - Array of instructions, each followed by its operands (see OPERANDS)
+		constants  - Constant pool, which CONSTANT and SEGMENT operands index into
+		error_link - Source information for each item in the code
+	'''
+
+	__slots__ = ['code', 'constants', 'error_link']
+
+	def __init__(self, code, constants, error_link):
+		self.code = code
+		self.constants = constants
+		self.error_link = error_link
 
 	def __len__(self):
-		return len(self.bytecode)
+		return len(self.code)
 
 	def __repr__(self):
-		return f'Bytecode @{id(self.bytecode)}'
+		return f'Bytecode @{id(self)}'
+
+	def instructions(self):
+		''' Iterates over the instructions in the segment, producing
+			the address, the instruction and the decoded operands of each one.
+		'''
+		place = 0
+		while place < len(self.code):
+			inst = I(self.code[place])
+			kinds = OPERANDS.get(inst, ())
+			operands = [
+				self.constants[value] if kind in (Operand.CONSTANT, Operand.SEGMENT) else value
+				for kind, value in zip(kinds, self.code[place + 1:place + 1 + len(kinds)])
+			]
+			yield place, inst, operands
+			place += 1 + len(kinds)
 
 	def dump(self, release = False):
 		''' Produces a representation of the bytecode that should,
@@ -215,28 +281,27 @@ class ConstructedBytecode:
 		'''
 		result = []
 		sources = {}
-		for i, e in zip(self.bytecode, self.error_link):
-			if i is None:
-				result.append(['nul'])
-			elif isinstance(i, I):
-				result.append([
-					'ist',
-					int(i),
-					'0' if release or e is None else e['position'],
-					'?' if release or e is None else e['name']
-				])
-				if e is not None:
-					sources[e['name']] = e['code']
-			elif isinstance(i, str):
-				result.append(['str', i])
-			elif isinstance(i, (int, sympy.Integer)):
-				result.append(['int', int(i)])
-			elif isinstance(i, (float, sympy.Number)):
-				result.append(['flt', i])
-			elif isinstance(i, complex):
-				result.append(['cpx', i.real, i.imag])
-			else:
-				raise Exception('Unknown bytecode item: {} ({})'.format(str(i), i.__class__))
+		for place, inst, operands in self.instructions():
+			e = self.error_link[place]
+			result.append([
+				'ist',
+				int(inst),
+				'0' if release or e is None else e['position'],
+				'?' if release or e is None else e['name']
+			])
+			if e is not None:
+				sources[e['name']] = e['code']
+			for i in operands:
+				if isinstance(i, str):
+					result.append(['str', i])
+				elif isinstance(i, (int, sympy.Integer)):
+					result.append(['int', int(i)])
+				elif isinstance(i, (float, sympy.Number)):
+					result.append(['flt', i])
+				elif isinstance(i, complex):
+					result.append(['cpx', i.real, i.imag])
+				else:
+					raise Exception('Unknown bytecode item: {} ({})'.format(str(i), i.__class__))
 		toline = lambda items : ' '.join(map(str, items))
 		result = 'bytecode 0 0 0 (unstable)\n' + '\n'.join(map(toline, result)) + '\n'
 		if not release:
@@ -254,27 +319,99 @@ class Builder:
 	def __init__(self):
 		self.globalscope = Scope([])
 		self.extrascope = {}
+		# Changes whenever a new global name is added. Builders with the same
+		# version give the same indices to every name, so can share code.
+		self.version = b''
 
 	def build(self, *asts, unsafe=False):
 		segment = CodeSegment(self)
 		for i in asts:
 			segment.add_ast(i, unsafe=unsafe)
-		segment.resolve_jump_addresses()
 		segment.push(I.END)
-		return ConstructedBytecode(segment)
+		return segment.link()
+
+	def copy(self):
+		''' Creates a builder that knows about all the global
+			names this one does, but can be extended independently.
+		'''
+		builder = Builder()
+		builder.globalscope.name_mapping = dict(self.globalscope.name_mapping)
+		builder.extrascope = dict(self.extrascope)
+		builder.version = self.version
+		return builder
 
 	def resolve_name(self, name):
 		if name not in self.extrascope:
 			self.extrascope[name] = len(self.extrascope)
+			self.version = hashlib.blake2b(self.version + b'\0' + name.encode('utf-8'), digest_size=16).digest()
 		return self.extrascope[name]
 
 
+class CompileCache:
+
+	''' Remembers the code that recently compiled source produced,
+		so that running the same thing again doesn't need to
+		tokenize, parse or compile it.
+
+		Entries are keyed on the source and the version of the builder,
+		since the compiled code refers to global variables by index.
+		Compiling can add new global names to the builder, so these are
+		recorded and added again when the entry is reused.
+
+		Error messages refer to the source name that the code was
+		originally compiled with.
+	'''
+
+	def __init__(self, capacity=1000, max_source_length=2000):
+		self.capacity = capacity
+		self.max_source_length = max_source_length
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def compile(self, builder, source, source_name='__unknown__', unsafe=False):
+		key = (source, builder.version, unsafe)
+		entry = self.entries.get(key)
+		if entry is not None:
+			self.entries.move_to_end(key)
+			self.hits += 1
+			segment, new_names = entry
+			for name in new_names:
+				builder.resolve_name(name)
+			return segment
+		self.misses += 1
+		_, ast = parser.parse(source, source_name=source_name)
+		known_names = len(builder.extrascope)
+		segment = builder.build(ast, unsafe=unsafe)
+		if len(source) <= self.max_source_length:
+			new_names = list(builder.extrascope)[known_names:]
+			self.entries[key] = (segment, new_names)
+			if len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
+		return segment
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'entries': len(self.entries),
+			'capacity': self.capacity
+		}
+
+
+COMPILE_CACHE = CompileCache()
+
+
 class CodeSegment:
 
 	def __init__(self, master):
 		self.bytecode = []
 		self.error_link = []
 		self.master = master
+		self.constructed = None
 
 
 	def add_ast(self, ast, unsafe=False):
@@ -287,21 +424,47 @@ class CodeSegment:
 			)
 		)
 
-	def resolve_jump_addresses(self):
-		for i, v in enumerate(self.bytecode):
-			if isinstance(v, Destination):
-				v.index = i
-				v.segment = self
-		for i, v in enumerate(self.bytecode):
-			if isinstance(v, GlobalToken):
-				self.bytecode[i] = self.master.resolve_name(v.name)
-			if isinstance(v, Pointer):
-				self.bytecode[i] = (
-					ConstructedBytecode(v.destination.segment),
-					v.destination.index
-				)
-			if isinstance(v, Destination):
-				self.bytecode[i] = I.NOTHING
+	def link(self):
+		''' Produces the compiled form of the segment.
+			Destinations take up no space in the compiled code,
+			and pointers are resolved to the addresses they refer to.
+		'''
+		address = 0
+		for i in self.bytecode:
+			if isinstance(i, Destination):
+				i.segment = self
+				i.index = address
+			else:
+				address += 1
+		code = array.array(CODE_TYPECODE)
+		constants = []
+		error_link = []
+		items = (i for i in zip(self.bytecode, self.error_link) if not isinstance(i[0], Destination))
+		for inst, error in items:
+			if not isinstance(inst, I):
+				raise calculator.errors.CompilationError(f'Expected an instruction but found {inst!r}')
+			code.append(inst)
+			error_link.append(error)
+			for kind in OPERANDS.get(inst, ()):
+				value, error = next(items)
+				code.append(self.link_operand(kind, value, constants))
+				error_link.append(error)
+		self.constructed = ConstructedBytecode(code, constants, error_link)
+		return self.constructed
+
+	def link_operand(self, kind, value, constants):
+		if kind == Operand.GLOBAL:
+			return self.master.resolve_name(value.name)
+		if kind == Operand.LABEL:
+			if value.destination.segment is not self:
+				raise calculator.errors.CompilationError('Attempted to jump between segments')
+			return value.destination.index
+		if kind == Operand.SEGMENT:
+			value = (value.destination.segment.constructed, value.destination.index)
+		if kind in (Operand.CONSTANT, Operand.SEGMENT):
+			constants.append(value)
+			return len(constants) - 1
+		return int(value)
 
 	def push(self, *bytecode, error = None):
 		self.bytecode += bytecode
@@ -625,6 +788,7 @@ class CodeSegment:
 		# Function header information
 		contents.push(
 			start_address,                 # Landing place
+			I.FUNCTION_HEADER,
 			node.get('name', '?').lower(), # name
 			len(params),                   # number of required parameters
 			node.get('variadic', 0),       # whether the function accepts additional parameters
@@ -638,17 +802,13 @@ class CodeSegment:
 			I.STORE_IN_CACHE,
 			I.RETURN
 		)
-		contents.resolve_jump_addresses()
+		contents.link()
 		return Pointer(start_address)
 
 
-def ast_to_bytecode(ast, unsafe=False, add_terminal_byte=True) -> ConstructedBytecode:
+def ast_to_bytecode(ast, unsafe=False) -> ConstructedBytecode:
 	builder = Builder()
-	segment = builder.build(ast)
-	if add_terminal_byte:
-		segment.bytecode.append(I.END)
-		segment.error_link.append(None)
-	return segment
+	return builder.build(ast, unsafe=unsafe)
 
 
 def convert_number(x):
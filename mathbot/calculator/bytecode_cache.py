@@ -0,0 +1,379 @@
+''' Stores compiled bytecode on disk so that code which has been
+	compiled before (such as the standard library) doesn't need to
+	be tokenized, parsed and compiled again.
+
+	File format (all integers are little endian):
+
+		magic                 b'C5BC'
+		format version        u16
+		key                   32 bytes
+		names                 u32 count, then strings
+		sources               u32 count, then (name, code) string pairs
+		segments              u32 count, then for each segment:
+			code              u32 count, then u32 items
+			globals           u32 count, then u32 offsets into the code
+			constants         u32 count, then tagged values
+			error links       for each item in the code: i32 source, u32 position
+
+	Strings are stored as a u32 byte length followed by utf-8.
+
+	Global variable operands are stored as an index into the names
+	table, and are resolved against the builder when the file is loaded.
+	This means that the same file can be loaded into any builder.
+'''
+
+import os
+import struct
+import hashlib
+import functools
+import array
+import collections
+import sympy
+
+import calculator.parser as parser
+import calculator.bytecode as bytecode
+
+
+MAGIC = b'C5BC'
+FORMAT_VERSION = 1
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(__file__), '__pycache__', 'bytecode')
+
+# Segments that have already been compiled or loaded by this process, keyed
+# on the cache key and the version of the builder. The same code (such as a
+# library used by many servers) is shared between every terminal that runs it.
+LOADED = collections.OrderedDict()
+LOADED_CAPACITY = 100
+
+
+class BundleError(Exception):
+	''' Raised when bytecode can't be saved or loaded '''
+
+
+@functools.lru_cache(1)
+def compiler_version():
+	''' Hash of the code that the compiler is made of.
+		Any change to the compiler invalidates previously stored bytecode.
+	'''
+	digest = hashlib.sha256()
+	for module in [parser, bytecode]:
+		with open(module.__file__, 'rb') as f:
+			digest.update(f.read())
+	digest.update(sympy.__version__.encode('utf-8'))
+	return digest.hexdigest()
+
+
+def cache_key(source, source_name, unsafe=False):
+	''' Key used to decide whether stored bytecode is still valid '''
+	digest = hashlib.sha256()
+	for part in [str(FORMAT_VERSION), compiler_version(), source_name, str(int(unsafe)), source]:
+		encoded = part.encode('utf-8')
+		digest.update(struct.pack('<I', len(encoded)))
+		digest.update(encoded)
+	return digest.digest()
+
+
+def compile_cached(builder, source, source_name, unsafe=False, directory=CACHE_DIRECTORY):
+	''' Compiles some source code using the given builder, using
+		stored bytecode if it's available. Newly compiled code is stored
+		for next time. Tokenization and parse errors are raised as usual.
+		If directory is None, nothing is written to disk and the code is
+		only shared with the rest of this process.
+	'''
+	key = cache_key(source, source_name, unsafe)
+	entry = LOADED.get((key, builder.version))
+	if entry is not None:
+		LOADED.move_to_end((key, builder.version))
+		segment, new_names = entry
+		for name in new_names:
+			builder.resolve_name(name)
+		return segment
+	version = builder.version
+	known_names = len(builder.extrascope)
+	segment = _compile_cached(builder, source, source_name, unsafe, directory, key)
+	LOADED[(key, version)] = (segment, list(builder.extrascope)[known_names:])
+	if len(LOADED) > LOADED_CAPACITY:
+		LOADED.popitem(last=False)
+	return segment
+
+
+def _compile_cached(builder, source, source_name, unsafe, directory, key):
+	if directory is None:
+		_, ast = parser.parse(source, source_name=source_name)
+		return builder.build(ast, unsafe=unsafe)
+	path = os.path.join(directory, key.hex() + '.c5b')
+	try:
+		with open(path, 'rb') as f:
+			return load(builder, f.read(), key)
+	except (OSError, BundleError):
+		pass
+	_, ast = parser.parse(source, source_name=source_name)
+	segment = builder.build(ast, unsafe=unsafe)
+	try:
+		data = dump(builder, segment, key)
+		os.makedirs(directory, exist_ok=True)
+		temporary = f'{path}.{os.getpid()}.tmp'
+		with open(temporary, 'wb') as f:
+			f.write(data)
+		os.replace(temporary, path)
+	except (OSError, BundleError):
+		pass
+	return segment
+
+
+class Writer:
+
+	def __init__(self):
+		self.parts = []
+
+	def u16(self, value):
+		self.parts.append(struct.pack('<H', value))
+
+	def u32(self, value):
+		self.parts.append(struct.pack('<I', value))
+
+	def i32(self, value):
+		self.parts.append(struct.pack('<i', value))
+
+	def raw(self, data):
+		self.parts.append(data)
+
+	def string(self, value):
+		encoded = value.encode('utf-8')
+		self.u32(len(encoded))
+		self.raw(encoded)
+
+	def getvalue(self):
+		return b''.join(self.parts)
+
+
+class Reader:
+
+	def __init__(self, data):
+		self.data = data
+		self.place = 0
+
+	def raw(self, size):
+		if self.place + size > len(self.data):
+			raise BundleError('Unexpected end of data')
+		result = self.data[self.place:self.place + size]
+		self.place += size
+		return result
+
+	def unpack(self, fmt):
+		return struct.unpack(fmt, self.raw(struct.calcsize(fmt)))[0]
+
+	def u16(self):
+		return self.unpack('<H')
+
+	def u32(self):
+		return self.unpack('<I')
+
+	def i32(self):
+		return self.unpack('<i')
+
+	def string(self):
+		try:
+			return self.raw(self.u32()).decode('utf-8')
+		except UnicodeDecodeError:
+			raise BundleError('Invalid string')
+
+
+def find_segments(root):
+	''' Finds all the segments that can be reached from the root '''
+	segments = [root]
+	index = {id(root): 0}
+	for segment in segments:
+		for value in segment.constants:
+			if isinstance(value, tuple) and id(value[0]) not in index:
+				index[id(value[0])] = len(segments)
+				segments.append(value[0])
+	return segments, index
+
+
+def dump(builder, root, key):
+	''' Serializes a segment, and all the segments it refers to '''
+	names = {i: n for n, i in builder.extrascope.items()}
+	segments, segment_index = find_segments(root)
+	global_offsets = [
+		[
+			offset
+			for place, inst, _ in segment.instructions()
+			for offset, kind in enumerate(bytecode.OPERANDS.get(inst, ()), start=place + 1)
+			if kind == bytecode.Operand.GLOBAL
+		]
+		for segment in segments
+	]
+	# Keep names in the order the builder saw them, so that loading into
+	# a fresh builder gives the same indices as compiling would have
+	used = sorted({segment.code[offset] for segment, offsets in zip(segments, global_offsets) for offset in offsets})
+	name_table = {names[index]: i for i, index in enumerate(used)}
+	source_table = {}
+	encoded_segments = []
+	for segment, globals_ in zip(segments, global_offsets):
+		code = array.array(bytecode.CODE_TYPECODE, segment.code)
+		for offset in globals_:
+			code[offset] = name_table[names[code[offset]]]
+		links = []
+		for link in segment.error_link:
+			if link is None:
+				links.append((-1, 0))
+			elif set(link) == {'name', 'code', 'position'}:
+				source = (link['name'], link['code'])
+				links.append((source_table.setdefault(source, len(source_table)), link['position']))
+			else:
+				raise BundleError('Unknown error link')
+		encoded_segments.append((code, globals_, segment.constants, links))
+	writer = Writer()
+	writer.raw(MAGIC)
+	writer.u16(FORMAT_VERSION)
+	writer.raw(key)
+	writer.u32(len(name_table))
+	for name in name_table:
+		writer.string(name)
+	writer.u32(len(source_table))
+	for name, code in source_table:
+		writer.string(name)
+		writer.string(code)
+	writer.u32(len(encoded_segments))
+	for code, globals_, constants, links in encoded_segments:
+		writer.u32(len(code))
+		writer.raw(struct.pack(f'<{len(code)}I', *code))
+		writer.u32(len(globals_))
+		writer.raw(struct.pack(f'<{len(globals_)}I', *globals_))
+		writer.u32(len(constants))
+		for value in constants:
+			dump_constant(writer, value, segment_index)
+		for source, position in links:
+			writer.i32(source)
+			writer.u32(position)
+	data = writer.getvalue()
+	# Make sure that everything survives the trip, since some constants
+	# (such as floats) are easy to get subtly wrong.
+	check, _ = find_segments(load(bytecode.Builder(), data, key))
+	for original, loaded in zip(segments, check):
+		for a, b in zip(original.constants, loaded.constants):
+			if type(a) != type(b) or (not isinstance(a, tuple) and a != b):
+				raise BundleError(f'Constant {a!r} did not survive serialization')
+	return data
+
+
+def load(builder, data, key):
+	''' Loads a segment that was stored by dump, resolving its global
+		variables against the given builder.
+	'''
+	reader = Reader(data)
+	if reader.raw(len(MAGIC)) != MAGIC:
+		raise BundleError('Not a bytecode file')
+	if reader.u16() != FORMAT_VERSION:
+		raise BundleError('Unsupported format version')
+	if reader.raw(len(key)) != key:
+		raise BundleError('Bytecode is out of date')
+	names = [reader.string() for _ in range(reader.u32())]
+	sources = [(reader.string(), reader.string()) for _ in range(reader.u32())]
+	resolved = [builder.resolve_name(name) for name in names]
+	segments = []
+	pending_constants = []
+	for _ in range(reader.u32()):
+		size = reader.u32()
+		code = array.array(bytecode.CODE_TYPECODE, struct.unpack(f'<{size}I', reader.raw(size * 4)))
+		count = reader.u32()
+		for offset in struct.unpack(f'<{count}I', reader.raw(count * 4)):
+			code[offset] = resolved[code[offset]]
+		constants = [load_constant(reader) for _ in range(reader.u32())]
+		error_link = []
+		for _ in range(size):
+			source = reader.i32()
+			position = reader.u32()
+			if source == -1:
+				error_link.append(None)
+			else:
+				name, text = sources[source]
+				error_link.append({'name': name, 'code': text, 'position': position})
+		segments.append(bytecode.ConstructedBytecode(code, constants, error_link))
+		pending_constants.append(constants)
+	# Pointers to segments can only be filled in once all of them exist
+	for constants in pending_constants:
+		for i, value in enumerate(constants):
+			if isinstance(value, SegmentReference):
+				constants[i] = (segments[value.segment], value.address)
+	if not segments:
+		raise BundleError('No code')
+	return segments[0]
+
+
+class SegmentReference:
+
+	__slots__ = ['segment', 'address']
+
+	def __init__(self, segment, address):
+		self.segment = segment
+		self.address = address
+
+
+def dump_constant(writer, value, segment_index):
+	if isinstance(value, tuple):
+		segment, address = value
+		writer.raw(b'p')
+		writer.u32(segment_index[id(segment)])
+		writer.u32(address)
+	elif isinstance(value, bool):
+		writer.raw(b'b')
+		writer.u32(int(value))
+	elif isinstance(value, int):
+		writer.raw(b'i')
+		writer.string(str(value))
+	elif isinstance(value, str):
+		writer.raw(b's')
+		writer.string(value)
+	elif isinstance(value, sympy.Integer):
+		writer.raw(b'Z')
+		writer.string(str(value.p))
+	elif isinstance(value, sympy.Rational):
+		writer.raw(b'Q')
+		writer.string(str(value.p))
+		writer.string(str(value.q))
+	elif isinstance(value, sympy.Float):
+		sign, mantissa, exponent, bits = value._mpf_
+		writer.raw(b'F')
+		writer.u32(sign)
+		writer.string(hex(mantissa))
+		writer.string(str(exponent))
+		writer.u32(bits)
+		writer.u32(value._prec)
+	elif isinstance(value, sympy.Basic) and value.is_number and value.has(sympy.I):
+		real, imaginary = value.as_real_imag()
+		writer.raw(b'X')
+		dump_constant(writer, real, segment_index)
+		dump_constant(writer, imaginary, segment_index)
+	else:
+		raise BundleError(f'Cannot store constant {value!r}')
+
+
+def load_constant(reader):
+	tag = reader.raw(1)
+	if tag == b'p':
+		segment = reader.u32()
+		return SegmentReference(segment, reader.u32())
+	if tag == b'b':
+		return bool(reader.u32())
+	if tag == b'i':
+		return int(reader.string())
+	if tag == b's':
+		return reader.string()
+	if tag == b'Z':
+		return sympy.Integer(int(reader.string()))
+	if tag == b'Q':
+		p = int(reader.string())
+		return sympy.Rational(p, int(reader.string()))
+	if tag == b'F':
+		sign = reader.u32()
+		mantissa = reader.string()[2:]
+		exponent = int(reader.string())
+		bits = reader.u32()
+		return sympy.Float((sign, mantissa, exponent, bits), precision=reader.u32())
+	if tag == b'X':
+		real = load_constant(reader)
+		imaginary = load_constant(reader)
+		return real + imaginary * sympy.I
+	raise BundleError('Unknown constant type')
@@ -6,49 +6,128 @@
 
 
 import asyncio
+import os
 import multiprocessing
 import async_timeout
 import time
 import traceback
 import random
+import signal
 import logging
 
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
-if multiprocessing.get_start_method(allow_none=True) is None:
-	# Using the default, 'fork', causes
-	# =calc 3^7^7^7^7^7^8^8^7^7^7^8^8^8^7
-	# to break, and also the interrupe handlers in
-	# bot.py cause issues.
-	multiprocessing.set_start_method('spawn')
-	log.info('Crucible set multiprocessing start method')
+# Forking the main process directly causes
+# =calc 3^7^7^7^7^7^8^8^7^7^7^8^8^8^7
+# to break, and also the interrupe handlers in
+# bot.py cause issues. Instead, workers are forked from a
+# clean server process which has already imported sympy and
+# the calculator, so they start quickly and share its memory.
+# Spawning a new interpreter for each worker is the fallback
+# on platforms without forkserver.
+PRELOAD = ['sympy', 'calculator']
+
+if 'forkserver' in multiprocessing.get_all_start_methods():
+	CONTEXT = multiprocessing.get_context('forkserver')
+	CONTEXT.set_forkserver_preload(PRELOAD)
+else:
+	CONTEXT = multiprocessing.get_context('spawn')
+
+
+class MemoryLimitExceeded(Exception):
+	''' Raised when a job uses more memory than the crucible allows '''
+
+
+def limit_memory(limit):
+	''' Limits the address space of the current process '''
+	if limit is not None and resource is not None:
+		resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def reset_peak_memory():
+	''' Resets the peak RSS of the current process, so that it can be
+		measured for a single job. This only works on Linux.
+	'''
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except OSError:
+		pass
+
+
+def peak_memory():
+	''' Peak RSS of the current process in bytes, or None if it can't be determined '''
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
 
 
-def worker(pipe):
+def worker(pipe, memory_limit=None):
 	log.info('Crucible worker has started!')
+	limit_memory(memory_limit)
 	while True:
-		if pipe.poll(None):
-			func, args = pipe.recv()
-			pipe.send(func(*args))
-			del func, args
-		time.sleep(0.1)
+		try:
+			jobs = pipe.recv()
+		except EOFError:
+			# The main process has gone away
+			return
+		# Results are sent back one at a time, so that the main
+		# process can time each job separately
+		for func, args in jobs:
+			reset_peak_memory()
+			start = time.process_time()
+			try:
+				worked, value = True, func(*args)
+			except MemoryError:
+				worked, value = False, MemoryLimitExceeded()
+			except Exception as e:
+				worked, value = False, e
+			usage = (time.process_time() - start, peak_memory())
+			try:
+				pipe.send((worked, value) + usage)
+			except Exception as e:
+				pipe.send((False, RuntimeError(f'Result could not be sent: {e!r}')) + usage)
+			del func, args, value
+		del jobs
 
 
 def echo(argument):
 	return argument
 
 
+try:
+	PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+	PAGE_SIZE = 4096
+
+
 class Process:
 
-	__slots__ = ['_pipe', '_process']
+	__slots__ = ['_pipe', '_process', 'jobs']
 
-	def __init__(self):
-		self._pipe, child_pipe = multiprocessing.Pipe()
-		self._process = multiprocessing.Process(target=worker, args=(child_pipe,), daemon=True)
+	def __init__(self, memory_limit=None):
+		self._pipe, child_pipe = CONTEXT.Pipe()
+		self._process = CONTEXT.Process(target=worker, args=(child_pipe, memory_limit), daemon=True)
 		self._process.start()
+		self.jobs = 0
+
+	@property
+	def pid(self):
+		return self._process.pid
 
 	def send(self, value):
 		self._pipe.send(value)
@@ -59,6 +138,46 @@ class Process:
 	def poll(self):
 		return self._pipe.poll()
 
+	async def receive(self):
+		''' Waits for the next message from the process, letting the
+			event loop tell us when the pipe is readable rather than
+			polling it.
+		'''
+		loop = asyncio.get_event_loop()
+		readable = loop.create_future()
+		def on_readable():
+			if not readable.done():
+				readable.set_result(None)
+		descriptor = self._pipe.fileno()
+		loop.add_reader(descriptor, on_readable)
+		try:
+			await readable
+		finally:
+			loop.remove_reader(descriptor)
+		return self._pipe.recv()
+
+	def is_alive(self):
+		return self._process.is_alive()
+
+	async def was_killed(self):
+		''' Whether the process was killed outright, which usually
+			means that the system ran out of memory
+		'''
+		# Checking the exit code doesn't block, unlike join
+		for _ in range(100):
+			if self._process.exitcode is not None:
+				break
+			await asyncio.sleep(0.01)
+		return self._process.exitcode == -signal.SIGKILL
+
+	def memory_usage(self):
+		''' Resident set size of the process in bytes, or None if it can't be determined '''
+		try:
+			with open(f'/proc/{self._process.pid}/statm') as f:
+				return int(f.read().split()[1]) * PAGE_SIZE
+		except (OSError, ValueError, IndexError):
+			return None
+
 	def terminate(self):
 		self._process.terminate()
 
@@ -67,60 +186,257 @@ class StartupFailure(Exception):
 	pass
 
 
+class Result:
+
+	''' The outcome of a single job in a batch, along with the
+		CPU time (in seconds) and peak memory (in bytes) that it used.
+	'''
+
+	__slots__ = ['value', 'error', 'cpu_time', 'peak_memory']
+
+	def __init__(self, value=None, error=None, cpu_time=None, peak_memory=None):
+		self.value = value
+		self.error = error
+		self.cpu_time = cpu_time
+		self.peak_memory = peak_memory
+
+	def get(self):
+		''' Returns the value of the job, or raises the exception that it failed with '''
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+
 class Pool:
 
-	__slots__ = ['_semaphore', '_idle']
+	''' Runs functions in worker processes.
+
+		max_processes  Maximum number of jobs that can run at once
+		min_idle       Number of processes to keep started and waiting for jobs
+		max_jobs       Processes are replaced after running this many jobs
+		max_memory     Processes are replaced once their RSS exceeds this many bytes
+		memory_limit   Jobs fail with MemoryLimitExceeded if the process's address
+		               space would grow beyond this many bytes
+	'''
+
+	__slots__ = [
+		'_semaphore', '_idle', '_max_processes', '_min_idle', '_max_jobs', '_max_memory',
+		'_memory_limit', '_busy', '_starting', '_spawned', '_killed', '_recycled',
+		'_memory_errors', '_cpu_time', '_spawn_time', '_replenishing'
+	]
 
-	def __init__(self, max_processess):
-		self._semaphore = asyncio.Semaphore(max_processess)
+	def __init__(self, max_processes, *, min_idle=0, max_jobs=None, max_memory=None, memory_limit=None):
 		self._idle = []
+		self._busy = 0
+		self._starting = 0
+		self._spawned = 0
+		self._killed = 0
+		self._recycled = 0
+		self._memory_errors = 0
+		self._cpu_time = 0
+		self._spawn_time = 0
+		self._replenishing = None
+		self.configure(
+			max_processes=max_processes,
+			min_idle=min_idle,
+			max_jobs=max_jobs,
+			max_memory=max_memory,
+			memory_limit=memory_limit
+		)
+
+	def configure(self, *, max_processes, min_idle=0, max_jobs=None, max_memory=None, memory_limit=None):
+		''' Changes the limits of the pool. This should be done before any jobs are run. '''
+		self._semaphore = asyncio.Semaphore(max_processes)
+		self._max_processes = max_processes
+		self._min_idle = min(min_idle, max_processes)
+		self._max_jobs = max_jobs
+		self._max_memory = max_memory
+		self._memory_limit = memory_limit
+
+	def start(self):
+		''' Starts the idle processes in the background '''
+		self._replenish_soon()
+
+	def stats(self):
+		return {
+			'idle': len(self._idle),
+			'busy': self._busy,
+			'starting': self._starting,
+			'spawned': self._spawned,
+			'killed': self._killed,
+			'recycled': self._recycled,
+			'memory_errors': self._memory_errors,
+			'cpu_time': self._cpu_time,
+			'mean_spawn_time': self._spawn_time / self._spawned if self._spawned else None
+		}
 
 	async def run(self, function, arguments, *, timeout=5):
-		proc = None
-		result = None
+		result, = await self.run_batch([(function, arguments, timeout)])
+		return result.get()
+
+	async def run_batch(self, jobs, *, abandon_on_failure=False):
+		''' Runs several jobs in one process, sending them all in a single
+			message. jobs is a list of (function, arguments, timeout) tuples,
+			where each timeout only covers its own job. Returns a list
+			of Result objects, in the same order as the jobs.
+			If a job times out or kills its process, the jobs after it are
+			run in another process, unless abandon_on_failure is True, in
+			which case they fail with the same error.
+		'''
+		results = []
+		if not jobs:
+			return results
 		async with self._semaphore:
+			proc = self._take_idle()
+			if proc is None:
+				proc = await self._spawn()
+			self._busy += 1
 			try:
-				if self._idle:
-					proc = self._idle.pop()
-				else:
-					proc = Process()
-					log.info(f'Starting new process: {id(proc)}')
-					# Starting a new process has an overhead, so we shoudld wait
-					# for it before starting the real timer.
-					secret = random.randint(0, 1 << 20)
-					result = await self._roundtrip(proc, echo, (secret,), 20)
-					if result == secret:
-						log.info(f'Process successfully started {id(proc)}')
+				proc.send([(function, arguments) for function, arguments, _ in jobs])
+				for _, _, timeout in jobs:
+					async with async_timeout.timeout(timeout):
+						worked, value, cpu_time, peak_memory = await proc.receive()
+					self._cpu_time += cpu_time
+					if worked:
+						results.append(Result(value, None, cpu_time, peak_memory))
 					else:
-						log.warning('Crucible failed to start subprocess')
-						raise StartupFailure
-				result = await self._roundtrip(proc, function, arguments, timeout)
-			except Exception:
-				log.error(f'Process has failed: {id(proc)}')
-				try:
-					proc.terminate()
-				except Exception:
-					print('Termination caused an exception')
-				else:
-					print('Termination succeeded')
+						if isinstance(value, MemoryLimitExceeded):
+							self._memory_errors += 1
+						results.append(Result(None, value, cpu_time, peak_memory))
+			except asyncio.TimeoutError as e:
+				log.error(f'Process has timed out: {proc.pid}')
+				self._kill(proc)
+				results.append(Result(error=e))
+			except (EOFError, ConnectionError) as e:
+				log.error(f'Process has died: {proc.pid}')
+				self._kill(proc)
+				if await proc.was_killed():
+					self._memory_errors += 1
+					e = MemoryLimitExceeded()
+				results.append(Result(error=e))
+			except BaseException:
+				log.error(f'Process has failed: {proc.pid}')
+				self._kill(proc)
 				raise
 			else:
+				self._release(proc, results)
+			finally:
+				self._busy -= 1
+		# The jobs after one that timed out still need to be run somewhere
+		remaining = jobs[len(results):]
+		if remaining and abandon_on_failure:
+			results += [Result(error=results[-1].error) for _ in remaining]
+		elif remaining:
+			results += await self.run_batch(remaining)
+		return results
+
+	def _release(self, proc, results):
+		''' Returns a process to the pool after it has finished some jobs '''
+		proc.jobs += len(results)
+		if self._should_recycle(proc, results):
+			log.info(f'Recycling process {proc.pid} after {proc.jobs} jobs')
+			self._recycled += 1
+			proc.terminate()
+			self._replenish_soon()
+		elif len(self._idle) + self._busy + self._starting > self._max_processes:
+			# Jobs and the background replenishing can briefly start
+			# more processes than the limit allows
+			proc.terminate()
+		else:
+			self._idle.append(proc)
+
+	def _take_idle(self):
+		while self._idle:
+			proc = self._idle.pop()
+			if proc.is_alive():
+				self._replenish_soon()
+				return proc
+			log.warning(f'Idle process {proc.pid} has died')
+			self._killed += 1
+		return None
+
+	def _should_recycle(self, proc, results):
+		# Running out of memory can leave a process in a bad state
+		if any(isinstance(result.error, MemoryLimitExceeded) for result in results):
+			return True
+		if self._max_jobs is not None and proc.jobs >= self._max_jobs:
+			return True
+		if self._max_memory is not None:
+			return (proc.memory_usage() or 0) > self._max_memory
+		return False
+
+	def _kill(self, proc):
+		self._killed += 1
+		try:
+			proc.terminate()
+		except Exception:
+			print('Termination caused an exception')
+		else:
+			print('Termination succeeded')
+		self._replenish_soon()
+
+	async def _spawn(self):
+		''' Starts a new process and waits until it's ready to run jobs '''
+		self._starting += 1
+		proc = None
+		try:
+			start = time.perf_counter()
+			proc = Process(self._memory_limit)
+			log.info(f'Starting new process: {proc.pid}')
+			# Starting a new process has an overhead, so we shoudld wait
+			# for it before starting the real timer.
+			secret = random.randint(0, 1 << 20)
+			proc.send([(echo, (secret,))])
+			async with async_timeout.timeout(20):
+				_, result, _, _ = await proc.receive()
+			if result != secret:
+				log.warning('Crucible failed to start subprocess')
+				raise StartupFailure
+		except BaseException:
+			if proc is not None:
+				self._kill(proc)
+			raise
+		finally:
+			self._starting -= 1
+		log.info(f'Process successfully started {proc.pid}')
+		self._spawned += 1
+		self._spawn_time += time.perf_counter() - start
+		return proc
+
+	def _needs_process(self):
+		total = len(self._idle) + self._busy + self._starting
+		return len(self._idle) + self._starting < self._min_idle and total < self._max_processes
+
+	def _replenish_soon(self):
+		if self._replenishing is None and self._needs_process():
+			self._replenishing = asyncio.ensure_future(self._replenish())
+
+	async def _replenish(self):
+		try:
+			while self._needs_process():
+				try:
+					proc = await self._spawn()
+				except Exception:
+					# Give up for now, the next job will try again
+					log.warning('Crucible failed to start an idle process')
+					break
 				self._idle.append(proc)
-		return result
-
-	@staticmethod
-	async def _roundtrip(proc, function, arguments, timeout):
-		async with async_timeout.timeout(timeout):
-			proc.send((function, arguments))
-			while not proc.poll():
-				await asyncio.sleep(0.01)
-			return proc.recv()
+		finally:
+			self._replenishing = None
 
 GLOBAL_POOL = Pool(4)
 async def run(function, arguments, *, timeout=5):
 	return await GLOBAL_POOL.run(function, arguments, timeout=timeout)
 
 
+async def run_batch(jobs, **kwargs):
+	return await GLOBAL_POOL.run_batch(jobs, **kwargs)
+
+
+def stats():
+	return GLOBAL_POOL.stats()
+
+
 def large():
 	print('Being large...')
 	large = 10000000
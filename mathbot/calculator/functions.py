@@ -55,14 +55,24 @@ class BuiltinFunction:
 
 class Function:
 
-	''' Calculator object the represents a function defined by some bytecode. '''
+	''' Calculator object the represents a function defined by some bytecode.
+		The details of the function are read from the bytecode once, when
+		the function is created (see interpereter.create_function).
+	'''
+
+	__slots__ = ['segment', 'address', 'scope', 'name', 'num_parameters', 'is_variadic', 'is_macro', 'code_address']
 
-	def __init__(self, segment, address, scope, name):
+	def __init__(self, segment, address, scope, name, *, num_parameters=0, is_variadic=False, is_macro=False):
 		# I'm not entirely happy about keeping the name in this thing.
 		self.segment = segment
 		self.address = address
 		self.scope = scope
 		self.name = name
+		self.num_parameters = num_parameters
+		self.is_variadic = is_variadic
+		self.is_macro = is_macro
+		# Skip over the function header
+		self.code_address = address + 5
 
 	def __repr__(self):
 		if self.name == '?':
@@ -215,6 +225,9 @@ class FlatList(ListBase):
 		def __len__(self):
 			return self.fl.size - self.place
 
+		def __reduce__(self):
+			return (FlatList.Viewer, (self.fl, self.place))
+
 
 	__slots__ = ['values', 'tail', 'place', 'size']
 
@@ -240,6 +253,9 @@ class FlatList(ListBase):
 	def __len__(self):
 		return self.size
 
+	def __reduce__(self):
+		return (FlatList, (self.values, self.tail))
+
 	def __str__(self):
 		parts = []
 		cur = self
@@ -257,6 +273,9 @@ class EmptyList(ListBase):
 	def __bool__(self):
 		return False
 
+	def __reduce__(self):
+		return (EmptyList, ())
+
 	@property
 	def head(self):
 		raise calculator.errors.EvaluationError('Attempt to get head of empty list')
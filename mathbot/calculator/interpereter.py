@@ -8,6 +8,7 @@ import numbers
 import sys
 import sympy
 import operator
+import functools
 import warnings
 import traceback
 
@@ -25,52 +26,95 @@ class ScopeMissedError(Exception):
 	pass
 
 
-DataSlot = collections.namedtuple('DataSlot', 'value security')
+class IndexedScope:
 
+	''' A set of variables, accessed by index.
+		Values are stored in a plain list, with None marking an empty slot.
+		Security levels are stored as bytes in a separate array, which
+		is only created once something has a non-zero level (normally
+		only the root scope). The list of values is used as-is, so callers
+		should not modify it afterwards.
+	'''
 
-class IndexedScope:
+	__slots__ = ['superscope', 'values', 'security']
 
 	# NOTE: Not really sure why I have both size and values here. 
 	def __init__(self, superscope, size, values):
 		self.superscope = superscope
 		if size != len(values):
 			raise calculator.errors.SystemError('Attempted to create a scope with number of values unequal to the size')
-		self.slots = [DataSlot(i, 0) for i in values]
-
-	def get(scope, index, depth):
+		self.values = values if isinstance(values, list) else list(values)
+		self.security = None
+
+	def find(scope, depth):
+		if depth == 0:
+			return scope
+		if depth == 1:
+			return scope.superscope
 		while depth > 0:
 			scope = scope.superscope
 			depth -= 1
-		if index >= len(scope.slots) or scope.slots[index].value is None:
+		return scope
+
+	def get(scope, index, depth):
+		if depth == 1:
+			scope = scope.superscope
+		elif depth != 0:
+			scope = scope.find(depth)
+		try:
+			value = scope.values[index]
+		except IndexError:
+			raise ScopeMissedError
+		if value is None:
 			raise ScopeMissedError
-		return scope.slots[index].value
+		return value
+
+	def get_security(self, index):
+		if self.security is None or index >= len(self.security):
+			return 0
+		return self.security[index]
+
+	def set_security(self, index, protection):
+		if self.security is None:
+			self.security = bytearray()
+		if len(self.security) <= index:
+			self.security.extend(bytes(index + 1 - len(self.security)))
+		self.security[index] = protection
 
 	def set(scope, index, depth, value, permission = 0, protection = None):
-		while depth > 0:
-			scope = scope.superscope
-			depth -= 1
-		while len(scope.slots) <= index:
-			scope.slots.append(DataSlot(None, 0))
-		_, current_security = scope.slots[index]
+		scope = scope.find(depth)
+		values = scope.values
+		if len(values) <= index:
+			values.extend([None] * (index + 1 - len(values)))
+		current_security = scope.get_security(index)
 		if current_security > permission:
 			raise EvaluationError('Not permitted to perform this assignment')
-		scope.slots[index] = DataSlot(value, protection if protection is not None else current_security)
+		values[index] = value
+		if protection is not None and protection != current_security:
+			scope.set_security(index, protection)
 
 	def reset(scope, index, depth, permission = 0, protection = None):
-		while depth > 0:
-			scope = scope.superscope
-			depth -= 1
-		if index < len(scope.slots):
-			_, current_security = scope.slots[index]
+		scope = scope.find(depth)
+		if index < len(scope.values):
+			current_security = scope.get_security(index)
 			if current_security > permission:
 				raise EvaluationError('Not permitted to perform this unassignment')
-			scope.slots[index] = DataSlot(None, protection if protection is not None else current_security)
+			scope.values[index] = None
+			if protection is not None and protection != current_security:
+				scope.set_security(index, protection)
+
+	def copy(self):
+		''' Creates a scope with the same values that can be modified independently. '''
+		scope = IndexedScope(self.superscope, len(self.values), list(self.values))
+		if self.security is not None:
+			scope.security = bytearray(self.security)
+		return scope
 
 	def __repr__(self):
 		return 'indexed-scope'
 
 
-async def do_nothing_async():
+def do_nothing():
 	pass
 
 
@@ -80,6 +124,8 @@ async def protected_power(use_crucible, a, b):
 			return await calculator.crucible.run(_protected_power_crucible, (a, b), timeout=2)
 		except asyncio.TimeoutError:
 			raise EvaluationError('Operation timed out. Perhaps the values were too large?')
+		except calculator.crucible.MemoryLimitExceeded:
+			raise EvaluationError('Operation ran out of memory. Perhaps the values were too large?')
 	else:
 		return _protected_power_crucible(a, b)
 
@@ -93,95 +139,247 @@ def _protected_power_crucible(a, b):
 	return result
 
 
-class FunctionInspector:
-	''' Used to provide an abstraction around accessing information about a function,
-		as opposed to looking at the bytecode directly.
+def builtin_call_failed(function, arguments):
+	# pylint: disable=raising-format-tuple
+	if not arguments:
+		raise EvaluationError('Failed to call {} with no arguments.', function)
+	elif len(arguments) == 1:
+		raise EvaluationError('Failed to call {} on {}', function, arguments[0])
+	else:
+		raise EvaluationError('Failed to call {} on {}', function, arguments)
+
+
+def create_function(segment, address, scope):
+	''' Creates a function object from the function header in some bytecode.
 
 		Function data is stored as follows:
-			- (null) <- function_object.address
+			- FUNCTION_HEADER <- address
+			- name <- index into the constant pool
 			- num_arguments
 			- is_variadic <- either 0 or 1
 			- is_macro <- either 0 or 1
 			- (code starts here)
 	'''
+	code = segment.code
+	return Function(
+		segment,
+		address,
+		scope,
+		segment.constants[code[address + 1]],
+		num_parameters=code[address + 2],
+		is_variadic=bool(code[address + 3]),
+		is_macro=bool(code[address + 4])
+	)
+
+
+class CallFrame:
+
+	''' Where to go back to once a function returns.
+		Frames are kept around and reused by later calls.
+	'''
 
-	def __init__(self, interpereter, function_object):
-		assert isinstance(function_object, Function)
-		# This is all we need from the interpereter, so grab it
-		# if we need more information later we can take it
-		self.bytes = function_object.segment.bytecode
-		self.function_object = function_object
-		self.address = self.function_object.address
+	__slots__ = ['segment', 'place', 'scope', 'cache_key']
 
-	@property
-	def name(self):
-		return self.bytes[self.address + 1]
+	def __init__(self):
+		self.segment = None
+		self.place = 0
+		self.scope = None
+		self.cache_key = None
 
-	@property
-	def num_parameters(self):
-		return self.bytes[self.address + 2]
+	def clear(self):
+		self.segment = None
+		self.scope = None
+		self.cache_key = None
 
-	@property
-	def is_variadic(self):
-		return self.bytes[self.address + 3]
 
-	@property
-	def is_macro(self):
-		return self.bytes[self.address + 4]
+# Rough size of a reference to an object, plus the object's header
+ITEM_SIZE = 64
 
-	@property
-	def code_address(self):
-		return self.address + 5
 
-	@property
-	def code_segment(self):
-		return self.function_object.segment
+def estimate_size(value, depth=2, seen=None):
+	''' Cheaply estimates how much memory a value uses, in bytes.
+		Containers are only looked into a couple of levels deep,
+		and sequences are assumed to hold small items.
+		Functions include the code and the scope that they hold on to.
+		Segments and scopes whose ids are in seen aren't counted,
+		and ones that are counted are added to it.
+	'''
+	if isinstance(value, Function):
+		if seen is None:
+			seen = set()
+		return ITEM_SIZE + estimate_segment_size(value.segment, seen) + estimate_scope_size(value.scope, depth, seen)
+	if isinstance(value, sympy.Integer):
+		return ITEM_SIZE + sys.getsizeof(value.p)
+	if isinstance(value, sympy.Rational):
+		return ITEM_SIZE + sys.getsizeof(value.p) + sys.getsizeof(value.q)
+	if isinstance(value, sympy.Basic):
+		return ITEM_SIZE * (1 + len(value.args))
+	if isinstance(value, (tuple, list)):
+		if depth > 0:
+			return sys.getsizeof(value) + sum(estimate_size(i, depth - 1, seen) for i in value)
+		return sys.getsizeof(value) + ITEM_SIZE * len(value)
+	if isinstance(value, (Array, ListBase)):
+		return ITEM_SIZE * (1 + len(value))
+	if isinstance(value, (int, float, complex, str)):
+		return sys.getsizeof(value)
+	return ITEM_SIZE
+
+
+def estimate_segment_size(segment, seen):
+	''' Size of a segment of code, and the segments that its functions are in '''
+	size = 0
+	pending = [segment]
+	while pending:
+		segment = pending.pop()
+		if id(segment) in seen:
+			continue
+		seen.add(id(segment))
+		size += segment.code.itemsize * len(segment.code)
+		size += sys.getsizeof(segment.constants) + sys.getsizeof(segment.error_link)
+		for constant in segment.constants:
+			if isinstance(constant, tuple):
+				pending.append(constant[0])
+			else:
+				size += estimate_size(constant, 0)
+		# Error links are shared between the items that came from the same
+		# place in the source, and all refer to the same source code
+		for link in segment.error_link:
+			if link is not None and id(link) not in seen:
+				seen.add(id(link))
+				size += sys.getsizeof(link)
+				code = link.get('code')
+				if code is not None and id(code) not in seen:
+					seen.add(id(code))
+					size += sys.getsizeof(code)
+	return size
+
+
+def estimate_scope_size(scope, depth, seen):
+	''' Size of the scopes that a function has captured. The root scope
+		is left out, since it's made up of the values that are counted
+		on their own.
+	'''
+	size = 0
+	while scope is not None and scope.superscope is not None and id(scope) not in seen:
+		seen.add(id(scope))
+		size += sys.getsizeof(scope.values)
+		for value in scope.values:
+			if value is not None:
+				size += estimate_size(value, depth - 1, seen) if depth > 0 else ITEM_SIZE
+		scope = scope.superscope
+	return size
 
 
 class CallingCache:
 
-	def __init__(self, capacity=10000):
+	''' Remembers the results of function calls.
+		When there are more than capacity entries, or the estimated size of
+		the entries goes over byte_budget, the least recently used entries
+		are dropped. Entries that are estimated to be larger than
+		item_size_limit are not stored at all.
+	'''
+
+	MISSING = object()
+
+	def __init__(self, capacity=10000, byte_budget=None, item_size_limit=None):
+		self.capacity = capacity
+		self.byte_budget = byte_budget
+		self.item_size_limit = item_size_limit
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.skipped = 0
 		self.clear()
-		self.capacity = 10000
 
 	def __contains__(self, key):
 		return key in self.values
 
+	def __len__(self):
+		return len(self.values)
+
+	def lookup(self, key):
+		''' Returns the stored value, or CallingCache.MISSING '''
+		value = self.values.get(key, self.MISSING)
+		if value is self.MISSING:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.values.move_to_end(key)
+		return value
+
 	def __setitem__(self, key, value):
-		assert key not in self.values
+		size = 0
+		if self.byte_budget is not None or self.item_size_limit is not None:
+			size = estimate_size(key) + estimate_size(value)
+			if self.item_size_limit is not None and size > self.item_size_limit:
+				self.skipped += 1
+				return
+		if key in self.values:
+			self.total_size -= self.sizes[key]
 		self.values[key] = value
-		self.queue.append(key)
-		if len(self.queue) > self.capacity:
-			drop = self.queue.popleft()
-			del self.values[drop]
+		self.values.move_to_end(key)
+		self.sizes[key] = size
+		self.total_size += size
+		while len(self.values) > self.capacity or \
+				(self.byte_budget is not None and self.total_size > self.byte_budget):
+			drop, _ = self.values.popitem(last=False)
+			self.total_size -= self.sizes.pop(drop)
+			self.evictions += 1
 
 	def __getitem__(self, key):
 		return self.values[key]
 
 	def clear(self):
-		self.values = {}
-		self.queue = collections.deque()
+		self.values = collections.OrderedDict()
+		self.sizes = {}
+		self.total_size = 0
+
+	def stats(self):
+		return {
+			'entries': len(self.values),
+			'capacity': self.capacity,
+			'estimated_bytes': self.total_size,
+			'byte_budget': self.byte_budget,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'skipped': self.skipped
+		}
 
 
 class ErrorStopGap:
 
-	__slots__ = ['handler_segment', 'handler_address', 'should_pass']
+	__slots__ = ['handler_segment', 'handler_address', 'should_pass', 'frame_depth', 'scope']
 
-	def __init__(self, segment, address, should_pass):
+	def __init__(self, segment, address, should_pass, frame_depth, scope):
 		self.handler_segment = segment
 		self.handler_address = address
 		self.should_pass = should_pass
+		# Function calls that were in progress when the stopgap was placed
+		self.frame_depth = frame_depth
+		self.scope = scope
 
 
 class Interpereter:
 
-	def __init__(self, *, trace=False, yield_rate=100, use_crucible=False):
+	def __init__(self, *, trace=False, yield_rate=100, use_crucible=False,
+			cache_capacity=10000, cache_byte_budget=None, cache_item_size_limit=None):
 		self.use_crucible = use_crucible
-		self.calling_cache = CallingCache()
+		self.calling_cache = CallingCache(
+			capacity=cache_capacity,
+			byte_budget=cache_byte_budget,
+			item_size_limit=cache_item_size_limit
+		)
 		self.trace = trace
 		self.bytes = None
+		self.code = None
+		self.constants = None
 		self.place = 0
 		self.stack = [None]
+		self.frames = []
+		self.frame_depth = 0
+		# Total number of instructions run
+		self.ticks = 0
 		self.yield_rate = yield_rate
 		self.root_scope = IndexedScope(None, 0, [])
 		self.current_scope = self.root_scope
@@ -191,7 +389,7 @@ class Interpereter:
 		self.enable_exception_handler = True
 		b = bytecode.I # pylint: no-invalid-name
 		self.switch_dictionary = {
-			b.NOTHING: do_nothing_async,
+			b.NOTHING: do_nothing,
 			b.CONSTANT: self.inst_constant,
 			b.BIN_ADD: self.inst_add,
 			b.BIN_SUB: self.inst_sub,
@@ -253,6 +451,10 @@ class Interpereter:
 			b.CONSTANT_STRING: self.inst_constant_string,
 			b.CONSTANT_GLYPH: self.inst_constant_glyph
 		}
+		# Instructions are dispatched by indexing into this list
+		self.dispatch_table = [self.inst_unknown] * (max(b) + 1)
+		for instruction, handler in self.switch_dictionary.items():
+			self.dispatch_table[instruction] = handler
 
 	# def swap_bytecode(self, constructed_bytecode):
 	# 	self.bytes = code_constructed.bytecode
@@ -281,12 +483,24 @@ class Interpereter:
 	@property
 	def head(self):
 		'''Return the instruction under the playhead'''
-		return self.bytes[self.place]
+		return self.code[self.place]
 
 	def next(self):
 		''' Advance the playhead and result the new instruction '''
 		self.place += 1
-		return self.bytes[self.place]
+		return self.code[self.place]
+
+	def next_constant(self):
+		''' Advance the playhead and return the constant that it refers to '''
+		self.place += 1
+		return self.constants[self.code[self.place]]
+
+	def enter_segment(self, segment, place):
+		''' Move the playhead to a place in some segment of code '''
+		self.bytes = segment
+		self.code = segment.code
+		self.constants = segment.constants
+		self.place = place
 
 	@property
 	def top(self):
@@ -321,41 +535,68 @@ class Interpereter:
 		'''
 		self.assignment_protection_level = assignment_protection_level
 		self.assignment_auth_level = assignment_auth_level
-		self.bytes = segment
-		self.place = 0
-		if tick_limit is None:
-			while self.head != bytecode.I.END:
-				await self.tick()
-		else:
-			while self.head != bytecode.I.END and tick_limit > 0:
-				tick_limit -= 1
-				await self.tick()
-		if error_if_exhausted and tick_limit == 0:
+		self.enter_segment(segment, 0)
+		self.current_scope = self.root_scope
+		if self.frame_depth != 0:
+			# The last run was abandoned part way through a function
+			self.frames.clear()
+			self.frame_depth = 0
+		limit = sys.maxsize if tick_limit is None else tick_limit
+		remaining = limit
+		yield_rate = max(1, self.yield_rate)
+		until_yield = yield_rate
+		end = bytecode.I.END
+		try:
+			while self.code[self.place] != end and remaining > 0:
+				remaining -= 1
+				pending = self.tick()
+				if pending is not None:
+					await self.finish_tick(pending)
+				until_yield -= 1
+				if until_yield == 0:
+					until_yield = yield_rate
+					# Let the event loop do some work.
+					await asyncio.sleep(0)
+		finally:
+			self.ticks += limit - remaining
+		if error_if_exhausted and remaining == 0:
 			raise EvaluationError('Execution timed out (by tick count)')
 		if get_entire_stack:
 			return self.stack[1:]
 		return self.top
 
-	async def tick(self):
-		''' Run a single tick '''
+	def tick(self):
+		''' Run a single tick.
+			Most instructions are run to completion immediately. Instructions that
+			need to wait on something (such as the crucible) return an awaitable
+			instead, and the tick is completed by finish_tick.
+		'''
 		if self.trace:
-			print(self.place, self.head, self.stack)
-		inst = self.switch_dictionary.get(self.head)
-		if not isinstance(self.head, bytecode.I) or inst is None:
-			raise SystemError('Tried to run unknown instruction: ' + repr(self.head))
-		if self.enable_exception_handler:
-			try:
-				await inst()
-			except EvaluationError as error:
-				error._linking = self.erlnk[self.place]
-				if self.panic(error):
-					raise error
-		else:
-			await inst()
-		# Let the event loop do some work.
-		await asyncio.sleep(0)
+			print(self.place, bytecode.I(self.head), self.stack)
+		try:
+			pending = self.dispatch_table[self.code[self.place]]()
+		except EvaluationError as error:
+			self.handle_error(error)
+			pending = None
+		if pending is None:
+			self.place += 1
+		return pending
+
+	async def finish_tick(self, pending):
+		''' Complete a tick that was suspended by an instruction '''
+		try:
+			await pending
+		except EvaluationError as error:
+			self.handle_error(error)
 		self.place += 1
 
+	def handle_error(self, error):
+		if not self.enable_exception_handler:
+			raise error
+		error._linking = self.erlnk[self.place]
+		if self.panic(error):
+			raise error
+
 	def panic(self, error):
 		try:
 			while not isinstance(self.top, ErrorStopGap):
@@ -364,65 +605,91 @@ class Interpereter:
 		except IndexError:
 			return True
 		stopgap = self.pop()
-		self.bytes = stopgap.handler_segment
-		self.place = stopgap.handler_address - 1
+		while self.frame_depth > stopgap.frame_depth:
+			self.frame_depth -= 1
+			self.frames[self.frame_depth].clear()
+		self.current_scope = stopgap.scope
+		self.enter_segment(stopgap.handler_segment, stopgap.handler_address - 1)
 		return False
 
-	async def inst_constant(self):
+	def inst_unknown(self):
+		raise SystemError('Tried to run unknown instruction: ' + repr(self.head))
+
+	def inst_constant(self):
 		''' Push a constant to the stack '''
-		self.place += 1
-		self.push(self.head)
+		self.push(self.next_constant())
 
-	async def inst_constant_empty_array(self):
+	def inst_constant_empty_array(self):
 		''' Push an empty array to the stack '''
 		warnings.warn('Instruction CONSTANT_EMPTY_ARRAY is deprecated', DeprecationWarning)
 		self.push(Array([]))
 
-	async def inst_constant_string(self):
+	def inst_constant_string(self):
 		''' Push a string to the stack '''
-		string = self.next()
+		string = self.next_constant()
 		self.push(create_list(map(Glyph, string)))
 
-	async def inst_constant_glyph(self):
+	def inst_constant_glyph(self):
 		''' Push a glyph to the stack '''
-		c = self.next()
+		c = self.next_constant()
 		self.push(Glyph(c))
 
-	async def inst_duplicate(self):
+	def inst_duplicate(self):
 		''' Duplicate the top item of the stack '''
 		self.push(self.top)
 
-	async def inst_stack_swap(self):
+	def inst_stack_swap(self):
 		''' Swap the top two items of the stack '''
 		a = self.pop()
 		b = self.pop()
 		self.push(a)
 		self.push(b)
 
-	async def inst_protected_mode_enable(self):
+	def inst_protected_mode_enable(self):
 		''' Specify that any assignments from now on should be protected '''
 		warnings.warn('Instruction BEGIN_PROTECTED_GLOBAL_BLOCK is deprecated', DeprecationWarning)
 		self.protected_assignment_mode = True
 
-	async def inst_protected_mode_disable(self):
+	def inst_protected_mode_disable(self):
 		''' Specify that any assignments from now on should not be protected '''
 		warnings.warn('Instruction END_PROTECTED_GLOBAL_BLOCK is deprecated', DeprecationWarning)
 		self.protected_assignment_mode = False
 
 	def make_bin_op_instruction(op, is_coroutine=False):
 		''' Create a handler for a binary operator instruction '''
-		async def internal(self):
-			left = self.pop()
-			right = self.pop()
-			try:
-				result = op(left, right)
-				if is_coroutine:
-					result = await result
-				self.push(result)
-			except EvaluationError:
-				raise
-			except Exception:
-				raise EvaluationError('Operation failed on {} and {}', left, right)
+		if is_coroutine:
+			async def internal(self):
+				left = self.pop()
+				right = self.pop()
+				try:
+					self.push(await op(left, right))
+				except EvaluationError:
+					raise
+				except Exception:
+					raise EvaluationError('Operation failed on {} and {}', left, right)
+		else:
+			def internal(self):
+				left = self.pop()
+				right = self.pop()
+				try:
+					self.push(op(left, right))
+				except EvaluationError:
+					raise
+				except Exception:
+					raise EvaluationError('Operation failed on {} and {}', left, right)
+		return internal
+
+	def make_bin_comparison_instruction(comparator, plain_comparator, make=make_bin_op_instruction):
+		''' Create a handler for a binary comparison instruction.
+			The plain comparator is used unless the operands need the
+			asyncronous comparitors (i.e. they're sequences).
+		'''
+		slow = make(comparator, is_coroutine=True)
+		fast = make(plain_comparator)
+		def internal(self):
+			if operators.requires_await(self.stack[-1], self.stack[-2]):
+				return slow(self)
+			fast(self)
 		return internal
 
 	inst_add = make_bin_op_instruction(operator.add)
@@ -431,25 +698,28 @@ class Interpereter:
 	inst_div = make_bin_op_instruction(operator.truediv)
 	inst_mod = make_bin_op_instruction(operator.mod)
 	# inst_pow = make_bin_op_instruction(protected_power, is_coroutine=True)
-	inst_bin_less = make_bin_op_instruction(operators.super_less_than, is_coroutine=True)
-	inst_bin_more = make_bin_op_instruction(operators.super_more_than, is_coroutine=True)
-	inst_bin_l_eq = make_bin_op_instruction(operators.super_less_eq, is_coroutine=True)
-	inst_bin_m_eq = make_bin_op_instruction(operators.super_more_eq, is_coroutine=True)
-	inst_bin_equl = make_bin_op_instruction(operators.super_equals, is_coroutine=True)
-	inst_bin_n_eq = make_bin_op_instruction(operators.super_not_equals, is_coroutine=True)
+	inst_bin_less = make_bin_comparison_instruction(operators.super_less_than, operators.plain_less_than)
+	inst_bin_more = make_bin_comparison_instruction(operators.super_more_than, operators.plain_more_than)
+	inst_bin_l_eq = make_bin_comparison_instruction(operators.super_less_eq, operators.plain_less_eq)
+	inst_bin_m_eq = make_bin_comparison_instruction(operators.super_more_eq, operators.plain_more_eq)
+	inst_bin_equl = make_bin_comparison_instruction(operators.super_equals, operators.plain_equals)
+	inst_bin_n_eq = make_bin_comparison_instruction(operators.super_not_equals, operators.plain_not_equals)
 	# inst_bin_die = make_bin_op_instruction(rolldie)
 	inst_and = make_bin_op_instruction(lambda a, b: (bool(a) and bool(b)))
 	inst_or = make_bin_op_instruction(lambda a, b: (bool(a) or bool(b)))
 
-	async def inst_pow(self):
-		def _internal(a, b):
-			return protected_power(self.use_crucible, a, b)
-		await Interpereter.make_bin_op_instruction(_internal, is_coroutine=True)(self)
+	inst_pow_local = make_bin_op_instruction(_protected_power_crucible)
+	inst_pow_crucible = make_bin_op_instruction(functools.partial(protected_power, True), is_coroutine=True)
+
+	def inst_pow(self):
+		if self.use_crucible:
+			return self.inst_pow_crucible()
+		self.inst_pow_local()
 
-	async def inst_unr_min(self):
+	def inst_unr_min(self):
 		self.push(-self.pop())
 
-	async def inst_unr_fac(self):
+	def inst_unr_fac(self):
 		''' Factorial operator '''
 		try:
 			original_value = self.pop()
@@ -465,45 +735,57 @@ class Interpereter:
 		self.push(result)
 		# self.push(operators.function_factorial(self.pop()))
 
-	async def inst_unr_not(self):
+	def inst_unr_not(self):
 		''' Unary not operator '''
 		self.push(int(not bool(self.pop())))
 
-	def make_comparison_instruction(comparator):
-		''' Create a handler for a binary comparison instruction '''
-		async def internal(self):
+	def make_comparison_instruction(comparator, plain_comparator):
+		''' Create a handler for a chain comparison instruction '''
+		def store(self, right, result):
+			self.stack[-1] = self.stack[-1] and result
+			self.push(right)
+		async def slow(self, left, right):
+			try:
+				result = bool(await comparator(left, right))
+			except EvaluationError:
+				raise
+			except Exception:
+				raise EvaluationError('Operation failed on {} and {}', left, right)
+			store(self, right, result)
+		def internal(self):
 			right = self.pop()
 			left = self.pop()
+			if operators.requires_await(left, right):
+				return slow(self, left, right)
 			try:
-				result = bool(await comparator(left, right))
+				result = bool(plain_comparator(left, right))
 			except EvaluationError:
 				raise
 			except Exception:
 				raise EvaluationError('Operation failed on {} and {}', left, right)
-			self.stack[-1] = self.stack[-1] and result
-			self.push(right)
+			store(self, right, result)
 		return internal
 
-	inst_cmp_less = make_comparison_instruction(operators.super_less_than)
-	inst_cmp_more = make_comparison_instruction(operators.super_more_than)
-	inst_cmp_l_eq = make_comparison_instruction(operators.super_less_eq)
-	inst_cmp_m_eq = make_comparison_instruction(operators.super_more_eq)
-	inst_cmp_equl = make_comparison_instruction(operators.super_equals)
-	inst_cmp_n_eq = make_comparison_instruction(operators.super_not_equals)
+	inst_cmp_less = make_comparison_instruction(operators.super_less_than, operators.plain_less_than)
+	inst_cmp_more = make_comparison_instruction(operators.super_more_than, operators.plain_more_than)
+	inst_cmp_l_eq = make_comparison_instruction(operators.super_less_eq, operators.plain_less_eq)
+	inst_cmp_m_eq = make_comparison_instruction(operators.super_more_eq, operators.plain_more_eq)
+	inst_cmp_equl = make_comparison_instruction(operators.super_equals, operators.plain_equals)
+	inst_cmp_n_eq = make_comparison_instruction(operators.super_not_equals, operators.plain_not_equals)
 
-	async def inst_discard(self):
+	def inst_discard(self):
 		''' Discard the top item of the stack '''
 		self.pop()
 
-	async def inst_jump_if_macro(self):
+	def inst_jump_if_macro(self):
 		''' Jumps to a place specified by the next instruction IFF the thing on the
 			top of the stack is both a function and a macro.
 		'''
 		self.place += 1
-		if isinstance(self.top, Function) and FunctionInspector(self, self.top).is_macro:
+		if isinstance(self.top, Function) and self.top.is_macro:
 			self.perform_jump()
 
-	async def inst_arg_list_end(self, disable_cache = False, do_tco = False):
+	def inst_arg_list_end(self, disable_cache = False, do_tco = False):
 		''' Specify the end of an argument list.
 			Pop the arguments off the stack and call the function.
 		'''
@@ -519,47 +801,45 @@ class Interpereter:
 			else:
 				arguments.append(arg)
 		function = self.pop()
-		await self.call_function(
+		return self.call_function(
 			function,
 			arguments,
-			(self.bytes, self.place + 1),
 			disable_cache=disable_cache,
 			do_tco=do_tco
 		)
 
-	async def inst_arg_list_end_no_cache(self):
+	def inst_arg_list_end_no_cache(self):
 		''' Specify the end of an argument list, but explicitly disable the cache. '''
-		await self.inst_arg_list_end(disable_cache = True)
+		return self.inst_arg_list_end(disable_cache = True)
 
-	async def inst_arg_list_end_with_tco(self):
+	def inst_arg_list_end_with_tco(self):
 		''' Specify the end of an argument list, but specify that tail call optimation can be employed.
 			An implementation of the interpereter _should_ be able to treat this as a normal ARG_LIST_END
 			with no penalty.
 		'''
-		await self.inst_arg_list_end(do_tco = True)
+		return self.inst_arg_list_end(do_tco = True)
 
-	async def inst_word(self):
+	def inst_word(self):
 		''' This is very deprecated '''
 		assert(False)
-		self.place += 1
-		self.push(self.current_scope[self.head])
+		self.push(self.current_scope[self.next_constant()])
 
-	async def inst_access_gobal(self):
+	def inst_access_gobal(self):
 		''' Retreive a global variable and push it to the top of the stack '''
 		index = self.next()
-		name = self.next()
+		name = self.next_constant()
 		try:
 			value = self.root_scope.get(index, 0)
 			self.push(value)
 		except ScopeMissedError:
 			raise calculator.errors.AccessFailedError(name)
 
-	async def inst_access_local(self):
+	def inst_access_local(self):
 		''' Access a local variable '''
 		self.place += 1
 		self.push(self.current_scope.get(self.head, 0))
 
-	async def inst_access_semi(self):
+	def inst_access_semi(self):
 		''' Access a variable from a scope above this one '''
 		depth = self.next()
 		index = self.next()
@@ -570,7 +850,7 @@ class Interpereter:
 			)
 		)
 
-	async def inst_access_array_element(self):
+	def inst_access_array_element(self):
 		index = self.pop()
 		array = self.pop()
 		if not isinstance(array, (Array, Interval)):
@@ -581,32 +861,25 @@ class Interpereter:
 			raise EvaluationError('Attempted to access out-of-bounds element of an array')
 		self.push(array(index))
 
-	async def inst_unload(self):
+	def inst_unload(self):
 		index = self.next()
 		self.root_scope.reset(index, 0)
 
-	async def inst_assignment(self):
+	def inst_assignment(self):
 		value = self.pop()
 		index = self.next()
 		self.root_scope.set(index, 0, value,
 			permission=self.assignment_auth_level, protection=self.assignment_protection_level)
 
-	async def inst_declare_symbol(self):
-		self.place += 1
-		index = self.head
-		self.place += 1
-		name = self.head
+	def inst_declare_symbol(self):
+		index = self.next()
+		name = self.next_constant()
 		value = sympy.symbols(name)
 		self.root_scope.set(index, 0, value)
 
-	async def inst_function(self):
-		self.place += 1
-		segment, address = self.head
-		# print(id(self.bytes), id(segment), address)
-		function = Function(segment, address, self.current_scope, '?')
-		inspector = FunctionInspector(self, function)
-		function.name = inspector.name
-		self.push(function)
+	def inst_function(self):
+		segment, address = self.next_constant()
+		self.push(create_function(segment, address, self.current_scope))
 
 	# async def inst_function_normal(self):
 	# 	self.place += 1
@@ -616,144 +889,143 @@ class Interpereter:
 	# 	self.place += 1
 	# 	self.push(Function(self.head, self.current_scope, True))
 
-	async def inst_return(self):
-		result = self.pop()
-		self.current_scope = self.pop()
-		self.bytes, self.place = self.pop()
-		self.place -= 1
-		self.push(result)
+	def inst_return(self):
+		self.frame_depth -= 1
+		frame = self.frames[self.frame_depth]
+		self.current_scope = frame.scope
+		self.enter_segment(frame.segment, frame.place)
+		frame.clear()
 
-	def perform_jump(self, allow_leap=False):
-		''' Jumps to the destination that is sitting under the head.
-			If allow_leap is False, landing in a different segment
-			to the one you started is forbidden.
+	def perform_jump(self):
+		''' Jumps to the address that is sitting under the head.
+			Jumps never leave the current segment.
 		'''
-		segment, index = self.head
-		# assert allow_leap or segment is self.bytes
-		self.bytes = segment
-		self.place = index - 1
+		self.place = self.code[self.place] - 1
 
-	async def inst_jump(self):
+	def inst_jump(self):
 		self.place += 1
 		self.perform_jump()
 
-	async def inst_jump_if_true(self):
+	def inst_jump_if_true(self):
 		self.place += 1
 		if self.pop():
 			self.perform_jump()
 
-	async def inst_jump_if_false(self):
+	def inst_jump_if_false(self):
 		self.place += 1
 		if not self.pop():
 			self.perform_jump()
 
-	async def inst_store_in_cache(self):
-		# print(self.stack)
-		value = self.pop()
-		cache_key = self.pop()
+	def inst_store_in_cache(self):
+		cache_key = self.frames[self.frame_depth - 1].cache_key
 		if cache_key is not None:
-			self.calling_cache[cache_key] = value
-		self.push(value)
+			self.calling_cache[cache_key] = self.top
 
-	async def inst_special_reduce_store(self):
+	def inst_special_reduce_store(self):
 		result = self.pop()
 		self.stack[-2] = result
 		self.stack[-1] += 1
 		self.place -= 1 + 1
 
-	async def inst_list_create_empty(self):
+	def inst_list_create_empty(self):
 		self.push(calculator.functions.EmptyList())
 
-	async def inst_list_extract_first(self):
+	def inst_list_extract_first(self):
 		value = self.pop()
 		if not isinstance(value, (calculator.functions.ListBase, calculator.functions.Array)):
 			raise EvaluationError('Attempted to extract head of non-list')
 		self.push(value.head)
 
-	async def inst_list_extract_rest(self):
+	def inst_list_extract_rest(self):
 		value = self.pop()
 		if not isinstance(value, (calculator.functions.ListBase, calculator.functions.Array)):
 			raise EvaluationError('Attempted to extract tail of non-list')
 		self.push(value.rest)
 
-	async def inst_list_prepend(self):
+	def inst_list_prepend(self):
 		new = self.pop()
 		lst = self.pop()
 		if not isinstance(lst, calculator.functions.ListBase):
 			raise EvaluationError('Attempt to prepend to start of non-list')
 		self.push(calculator.functions.List(new, lst))
 
-	async def inst_push_error_stopgap(self):
-		handler_segment, handler_address = self.next()
+	def inst_push_error_stopgap(self):
+		handler_address = self.next()
 		should_pass = self.next()
-		self.push(ErrorStopGap(handler_segment, handler_address, should_pass))
+		self.push(ErrorStopGap(self.bytes, handler_address, should_pass, self.frame_depth, self.current_scope))
 
-	async def call_builtin_function(self, function, arguments, return_to):
+	def call_builtin_function(self, function, arguments):
+		if isinstance(function, BuiltinFunction) and function.is_coroutine:
+			return self.call_builtin_coroutine(function, arguments)
 		try:
-			if isinstance(function, BuiltinFunction) and function.is_coroutine:
-				result = await function(*arguments)
-			else:
-				result = function(*arguments)
+			result = function(*arguments)
 		except Exception:
-			# arg = arguments if len(arguments)
-			# pylint: disable=raising-format-tuple
-			if not arguments:
-				raise EvaluationError('Failed to call {} with no arguments.', function)
-			elif len(arguments) == 1:
-				raise EvaluationError('Failed to call {} on {}', function, arguments[0])
-			else:
-				raise EvaluationError('Failed to call {} on {}', function, arguments)
-		except EvaluationError:
-			raise
+			builtin_call_failed(function, arguments)
 		self.push(result)
-		self.bytes, self.place = return_to
 
-	async def call_function(self, function, arguments, return_to, disable_cache=False, macro_unprepped=False, do_tco=False):
+	async def call_builtin_coroutine(self, function, arguments):
+		try:
+			result = await function(*arguments)
+		except Exception:
+			builtin_call_failed(function, arguments)
+		self.push(result)
+
+	def push_frame(self, cache_key):
+		''' Remember where to return to once the function being called is done '''
+		if self.frame_depth == len(self.frames):
+			self.frames.append(CallFrame())
+		frame = self.frames[self.frame_depth]
+		frame.segment = self.bytes
+		frame.place = self.place
+		frame.scope = self.current_scope
+		frame.cache_key = cache_key
+		self.frame_depth += 1
+
+	def call_function(self, function, arguments, disable_cache=False, macro_unprepped=False, do_tco=False):
+		''' Call a function. Returns an awaitable if the function
+			is a coroutine that needs to be waited on.
+			Builtin functions and cached results leave the playhead where it is,
+			so execution continues after the instruction that made the call.
+		'''
 		if isinstance(function, (BuiltinFunction, Array, Interval, SingularValue)):
-			await self.call_builtin_function(function, arguments, return_to)
-		elif isinstance(function, Function):
-			inspector = FunctionInspector(self, function)
-			need_to_call = True
-			if not disable_cache:
-				cache_key = tuple([function] + arguments)
-				if not inspector.is_macro and cache_key in self.calling_cache:
-					self.push(self.calling_cache[cache_key])
-					self.bytes, self.place = return_to
-					need_to_call = False
-			if need_to_call:
-				num_parameters = inspector.num_parameters
-				if inspector.is_variadic:
-					if len(arguments) < num_parameters - 1:
-						raise EvaluationError('Not enough arguments for variadic function {}', function)
-					main = arguments[:num_parameters - 1]
-					extra = arguments[num_parameters - 1:]
-					scope_array = main
-					scope_array.append(Array(extra))
-					new_scope = IndexedScope(function.scope, num_parameters, scope_array)
-				else:
-					if num_parameters != len(arguments):
-						raise EvaluationError('Improper number of arguments for function {}', function)
-					if num_parameters == 0:
-						new_scope = function.scope
-					elif inspector.is_macro and macro_unprepped:
-						wrapped = tuple(map(SingularValue, arguments))
-						new_scope = IndexedScope(function.scope, num_parameters, wrapped)
-					else:
-						new_scope = IndexedScope(function.scope, num_parameters, arguments)
-				# Remember the current scope
-				if not do_tco:
-					self.push(return_to)
-					self.push(self.current_scope)
-					# For normal functions, the last thing that happens is that the result is
-					# stored in a cache. Need the key in order to do that.
-					self.push(None if disable_cache or inspector.is_macro else cache_key)
-				# Enter the function
-				self.current_scope = new_scope
-				self.bytes = inspector.code_segment
-				self.place = inspector.code_address
-		else:
+			return self.call_builtin_function(function, arguments)
+		if not isinstance(function, Function):
 			raise EvaluationError('{} is not a function', function)
-		self.place -= 1 # Negate the +1 after this
+		is_macro = function.is_macro
+		cache_key = None
+		if not disable_cache and not is_macro:
+			cache_key = tuple([function] + arguments)
+			cached = self.calling_cache.lookup(cache_key)
+			if cached is not CallingCache.MISSING:
+				self.push(cached)
+				return
+		num_parameters = function.num_parameters
+		if function.is_variadic:
+			if len(arguments) < num_parameters - 1:
+				raise EvaluationError('Not enough arguments for variadic function {}', function)
+			main = arguments[:num_parameters - 1]
+			extra = arguments[num_parameters - 1:]
+			scope_array = main
+			scope_array.append(Array(extra))
+			new_scope = IndexedScope(function.scope, num_parameters, scope_array)
+		else:
+			if num_parameters != len(arguments):
+				raise EvaluationError('Improper number of arguments for function {}', function)
+			if num_parameters == 0:
+				new_scope = function.scope
+			elif is_macro and macro_unprepped:
+				wrapped = tuple(map(SingularValue, arguments))
+				new_scope = IndexedScope(function.scope, num_parameters, wrapped)
+			else:
+				new_scope = IndexedScope(function.scope, num_parameters, arguments)
+		# Remember the current scope
+		if not do_tco:
+			# For normal functions, the last thing that happens is that the result is
+			# stored in a cache. Need the key in order to do that.
+			self.push_frame(cache_key)
+		# Enter the function
+		self.current_scope = new_scope
+		self.enter_segment(function.segment, function.code_address - 1) # Negate the +1 after this
 
 	def get_memory_usage(self):
 		return deep_getsizeof(self)
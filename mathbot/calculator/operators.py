@@ -48,6 +48,30 @@ async def super_more_than(a, b):
 async def super_more_eq(a, b):
 	return (await super_equals(a, b)) or (await super_less_than(b, a))
 
+# Syncronous versions of the above, which can be used when
+# requires_await returns False for the operands.
+
+def requires_await(a, b):
+	return hasattr(a, '__aeq__') or hasattr(b, '__aeq__')
+
+def plain_equals(a, b):
+	return rectify_bool(a == b)
+
+def plain_not_equals(a, b):
+	return not plain_equals(a, b)
+
+def plain_less_than(a, b):
+	return rectify_bool(a < b)
+
+def plain_less_eq(a, b):
+	return plain_equals(a, b) or plain_less_than(a, b)
+
+def plain_more_than(a, b):
+	return plain_less_than(b, a)
+
+def plain_more_eq(a, b):
+	return plain_equals(a, b) or plain_less_than(b, a)
+
 
 class Overloadable:
 
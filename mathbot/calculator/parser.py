@@ -1,6 +1,7 @@
 import json
 import re
 import enum
+import operator
 
 
 class DelimitedBinding(enum.Enum):
@@ -144,8 +145,8 @@ class TokenBlock:
 			t = self.values[self.place + index]
 			if isinstance(t, TokenBlock):
 				return t.edge_type in valids or TokenBlock in valids
-			elif isinstance(t, dict):
-				return t['#'] in valids
+			elif isinstance(t, Token):
+				return t.kind in valids
 
 	def peek_sequence(self, index, *sequence):
 		for offset, item in enumerate(sequence):
@@ -156,8 +157,8 @@ class TokenBlock:
 	def peek_string(self, index, *valids):
 		if self.place + index < len(self.values):
 			t = self.values[self.place + index]
-			if isinstance(t, dict):
-				return t['string'] in valids
+			if isinstance(t, Token):
+				return t.string in valids
 
 	def peek_and_eat(self, index, *valids):
 		assert index == 0
@@ -631,7 +632,7 @@ def run(string):
 		print(' ' * e.position + '^')
 	else:
 		print(result)
-		print(json.dumps(result, indent = 4))
+		print(json.dumps(result, indent = 4, default = Token.as_dict))
 
 
 def run_script(module):
@@ -642,57 +643,118 @@ def run_script(module):
 	return run(data)
 
 
+class Source:
+
+	''' The code that a set of tokens came from '''
+
+	__slots__ = ['name', 'code']
+
+	def __init__(self, name, code):
+		self.name = name
+		self.code = code
+
+
+class Token:
+
+	''' A single token. Tokens sit directly in the syntax tree, so they
+		can be read like a dictionary with the keys '#', 'string',
+		'position', 'index' and 'source'. The source is only built when
+		it's asked for, tokens themselves only refer to the code by position.
+	'''
+
+	__slots__ = ['kind', 'string', 'position', 'index', 'origin']
+
+	def __init__(self, kind, string, position, index, origin = None):
+		self.kind = kind
+		self.string = string
+		self.position = position
+		self.index = index
+		self.origin = origin
+
+	def __getitem__(self, key):
+		if key == '#':
+			return self.kind
+		if key == 'string':
+			return self.string
+		if key == 'position':
+			return self.position
+		if key == 'index':
+			return self.index
+		if key == 'source' and self.origin is not None:
+			return {
+				'name': self.origin.name,
+				'code': self.origin.code,
+				'position': self.position
+			}
+		raise KeyError(key)
+
+	def get(self, key, default = None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def as_dict(self):
+		keys = ['#', 'string', 'position', 'index', 'source']
+		return {i: self[i] for i in keys if self.get(i) is not None}
+
+	def __repr__(self):
+		return 'Token({!r}, {!r}, {})'.format(self.kind, self.string, self.position)
+
+
+_MASTER_PATTERNS = {}
+
+
+def master_pattern(ttypes):
+	''' Combines the token types into a single pattern.
+		Leading whitespace is skipped, and then each type is wrapped in an
+		optional lookahead so that every type is tried at once and the
+		longest match can be picked afterwards.
+		Returns the pattern, a function that extracts the match for each type,
+		and the name and replacement of each type.
+	'''
+	key = tuple(map(tuple, ttypes))
+	if key not in _MASTER_PATTERNS:
+		pattern = re.compile(r'[ \n]*' + ''.join(
+			'(?:(?=(?P<t{}>{})))?'.format(i, x[1]) for i, x in enumerate(ttypes)
+		))
+		extract = operator.itemgetter(*(pattern.groupindex['t{}'.format(i)] - 1 for i in range(len(ttypes))))
+		types = [(x[0], x[2] if len(x) == 3 else None) for x in ttypes]
+		_MASTER_PATTERNS[key] = (pattern, extract, types)
+	return _MASTER_PATTERNS[key]
+
+
 def tokenizer(original_string, ttypes, source_name = '__unknown__'):
-	# print(string)
-	regexes = [x if len(x) == 3 else (x[0], x[1], None) for x in ttypes]
-	regexes = list(map(lambda x: (x[0], re.compile(x[1]), x[2]), regexes))
-	result = [{
-		'#': 'pseudotoken-start',
-		'string': '',
-		'position': 0,
-	}]
+	pattern, extract, types = master_pattern(ttypes)
+	origin = Source(source_name, original_string)
+	result = [Token('pseudotoken-start', '', 0, 0)]
 	# Hard coded thing here, maybe remove it.
 	string = original_string.replace('\t', ' ')
-	location = 0
-	while len(string) > 0:
-		if string[0] in ' \n':
-			string = string[1:]
-			location += 1
-		else:
-			possible = []
-			for name, cre, replacement in regexes:
-				# print(i)
-				match = cre.match(string)
-				if match is not None:
-					possible.append((name, replacement or match.group()))
-			possible.sort(key = lambda x: len(x[1]), reverse = True)
-			# print(possible)
-			if len(possible) == 0:
-				raise TokenizationFailed(location)
-				# raise TokenizationFailed(original_string, len(original_string) - len(string))
-			# print(possible[0][1])
-			if possible[0][0] == '__illegal__':
-				raise TokenizationFailed(location)
-			if possible[0][0] != '__remove__':
-				result.append({
-					'#': possible[0][0],
-					'string': possible[0][1],
-					'position': location,
-					'source': {
-						'name': source_name,
-						'code': original_string,
-						'position': location
-					}
-				})
-			location += len(possible[0][1])
-			string = string[len(possible[0][1]):]
-	result.append({
-		'#': 'pseudotoken-end',
-		'string': '',
-		'position': len(original_string.rstrip()) + 1
-	})
-	for i, v in enumerate(result):
-		v['index'] = i
+	match = pattern.match(string, 0)
+	location = match.end()
+	while location < len(string):
+		matches = extract(match.groups())
+		# Longest match wins, ties go to whichever type comes first
+		best_name = None
+		best_string = ''
+		for i in [i for i, m in enumerate(matches) if m is not None]:
+			name, replacement = types[i]
+			matched = replacement or matches[i]
+			if best_name is None or len(matched) > len(best_string):
+				best_name = name
+				best_string = matched
+		if best_name is None or best_name == '__illegal__':
+			raise TokenizationFailed(location)
+		if best_name != '__remove__':
+			result.append(Token(best_name, best_string, location, len(result), origin))
+		match = pattern.match(string, location + len(best_string))
+		location = match.end()
+	result.append(Token(
+		'pseudotoken-end',
+		'',
+		len(original_string.rstrip()) + 1,
+		len(result)
+	))
 	return result
 
 TOKEN_SPEC = [
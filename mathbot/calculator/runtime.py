@@ -16,6 +16,7 @@ from calculator.errors import EvaluationError
 import calculator.parser as parser
 import calculator.formatter as formatter
 import calculator.crucible as crucible
+import calculator.bytecode_cache as bytecode_cache
 
 
 ALL_SYMPY_CLASSES = tuple(sympy.core.core.all_classes)
@@ -224,13 +225,18 @@ def _prepare_runtime(exportable=False):
 			yield _assignment_code(name, BuiltinFunction(func, name))
 		for name, func in BUILTIN_COROUTINES.items():
 			yield _assignment_code(name, BuiltinFunction(func, name, is_coroutine=True))
-	_, ast = parser.parse(LIBRARY_CODE, source_name='_system_library')
-	yield ast
 
 
 @functools.lru_cache(4)
 def prepare_runtime(builder, **kwargs):
-	return  builder.build(*list(_prepare_runtime(**kwargs)), unsafe=True)
+	''' Returns the segments that need to be run (in order) to set up the runtime.
+		The library is loaded from stored bytecode when possible, since
+		the builtins refer to python objects they are always rebuilt.
+	'''
+	return [
+		builder.build(*list(_prepare_runtime(**kwargs)), unsafe=True),
+		bytecode_cache.compile_cached(builder, LIBRARY_CODE, '_system_library', unsafe=True)
+	]
 
 
 def wrap_simple(ast):
@@ -0,0 +1,228 @@
+''' Saves the global variables of a terminal, so that its state can be
+	restored later without running everything that produced it again.
+
+	A snapshot only holds the values the user created. Anything that
+	came from the runtime (builtins, library functions and the code
+	behind them) is stored as a reference to the runtime template,
+	so snapshots are small and can only be loaded into a terminal
+	that was made from the same version of the runtime.
+
+	Format:
+
+		magic                 b'C5SS'
+		key                   32 bytes (see snapshot_key)
+		signature             32 bytes, HMAC-SHA256 of the state
+		state                 zlib compressed pickle
+
+	Pickles can run code when they're loaded, so a snapshot is only
+	unpickled once its signature has been checked against a secret that
+	only the bot knows. Anyone who can write to the keystore therefore
+	can't make the bot load their own data. On top of that, only classes
+	from the calculator, sympy and mpmath can be loaded.
+'''
+
+import os
+import io
+import sys
+import glob
+import zlib
+import pickle
+import hmac
+import hashlib
+import functools
+
+import sympy
+
+import calculator.bytecode_cache as bytecode_cache
+from calculator.functions import Function
+
+
+MAGIC = b'C5SS'
+FORMAT_VERSION = 2
+
+# Modules that snapshots are allowed to load classes from
+ALLOWED_MODULES = ('calculator.', 'sympy.', 'mpmath.')
+# Other things that pickle uses to rebuild builtin types
+ALLOWED_GLOBALS = {
+	('array', 'array'),
+	('array', '_array_reconstructor'),
+	('copyreg', '_reconstructor'),
+	('builtins', 'object'),
+	('builtins', 'complex'),
+	('builtins', 'set'),
+	('builtins', 'frozenset'),
+	('builtins', 'bytearray')
+}
+
+
+class SnapshotError(Exception):
+	''' Raised when a snapshot can't be taken or restored '''
+
+
+@functools.lru_cache(1)
+def calculator_version():
+	''' Hash of all the code that the calculator is made of.
+		Snapshots hold bytecode and refer to parts of the runtime
+		by position, so any change invalidates them.
+	'''
+	digest = hashlib.sha256()
+	directory = os.path.dirname(__file__)
+	for filename in sorted(glob.glob(os.path.join(directory, '*.py')) + glob.glob(os.path.join(directory, '*.c5'))):
+		with open(filename, 'rb') as f:
+			digest.update(f.read())
+	digest.update(bytecode_cache.compiler_version().encode('utf-8'))
+	digest.update(sympy.__version__.encode('utf-8'))
+	digest.update(sys.version.encode('utf-8'))
+	return digest.hexdigest()
+
+
+def snapshot_key(template):
+	digest = hashlib.sha256()
+	digest.update(str(FORMAT_VERSION).encode('utf-8'))
+	digest.update(calculator_version().encode('utf-8'))
+	digest.update(template.builder.version)
+	digest.update(str(len(template.root_scope.values)).encode('utf-8'))
+	return digest.digest()
+
+
+@functools.lru_cache(8)
+def shared_objects(template):
+	''' Finds the objects that belong to the runtime template, which
+		snapshots refer to instead of storing.
+		Returns a mapping from object ids to references, and a
+		mapping from references back to the objects.
+	'''
+	objects = {('scope',): template.root_scope}
+	segments = []
+	for index, value in enumerate(template.root_scope.values):
+		if value is not None:
+			objects[('value', index)] = value
+		if isinstance(value, Function):
+			segments.append(value.segment)
+	seen = set()
+	for root in segments:
+		if id(root) not in seen:
+			for segment in bytecode_cache.find_segments(root)[0]:
+				if id(segment) not in seen:
+					seen.add(id(segment))
+					objects[('segment', len(seen) - 1)] = segment
+	return {id(value): reference for reference, value in objects.items()}, objects
+
+
+class Pickler(pickle.Pickler):
+
+	def __init__(self, file, terminal):
+		super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+		self.root_scope = terminal.interpereter.root_scope
+		self.shared, _ = shared_objects(terminal.runtime_template)
+
+	def persistent_id(self, value):
+		if value is self.root_scope:
+			return ('root',)
+		return self.shared.get(id(value))
+
+
+class Unpickler(pickle.Unpickler):
+
+	def __init__(self, file, terminal):
+		super().__init__(file)
+		self.root_scope = terminal.interpereter.root_scope
+		_, self.shared = shared_objects(terminal.runtime_template)
+
+	def persistent_load(self, reference):
+		if reference == ('root',):
+			return self.root_scope
+		try:
+			return self.shared[reference]
+		except (KeyError, TypeError):
+			raise SnapshotError(f'Unknown reference {reference!r}')
+
+	def find_class(self, module, name):
+		# Dotted names would let an allowed module lead to anything it imports
+		if '.' in name:
+			raise SnapshotError(f'Snapshot refers to {module}.{name}')
+		if (module, name) in ALLOWED_GLOBALS or module.startswith(ALLOWED_MODULES):
+			value = super().find_class(module, name)
+			if isinstance(value, type) or (module, name) in ALLOWED_GLOBALS:
+				return value
+		raise SnapshotError(f'Snapshot refers to {module}.{name}')
+
+
+def sign(secret, key, state):
+	return hmac.new(secret, key + state, hashlib.sha256).digest()
+
+
+def dump(terminal, secret):
+	''' Takes a snapshot of the variables in a terminal, signed with secret.
+		This must not be called while the terminal is running something.
+	'''
+	template = terminal.runtime_template
+	if template is None:
+		raise SnapshotError('Terminal was not created from a runtime template')
+	scope = terminal.interpereter.root_scope
+	security = scope.security or bytearray()
+	state = {
+		'names': list(terminal.builder.extrascope)[len(template.builder.extrascope):],
+		'version': terminal.builder.version,
+		'values': scope.values[terminal.runtime_size:],
+		'security': bytes(security[terminal.runtime_size:]),
+		'line_count': terminal.line_count
+	}
+	buffer = io.BytesIO()
+	try:
+		Pickler(buffer, terminal).dump(state)
+	except (pickle.PicklingError, TypeError, AttributeError, RecursionError) as e:
+		raise SnapshotError(f'Cannot store the state of the terminal: {e}')
+	key = snapshot_key(template)
+	state = zlib.compress(buffer.getvalue())
+	data = MAGIC + key + sign(secret, key, state) + state
+	# Make sure the snapshot can be read back, since the classes that
+	# are allowed when loading are more limited than what can be stored
+	_read(terminal, data, secret)
+	return data
+
+
+def load(terminal, data, secret):
+	''' Restores a snapshot into a terminal that has only just been
+		created. Snapshots that weren't signed with secret are rejected.
+		The terminal is left untouched on failure.
+	'''
+	if len(terminal.interpereter.root_scope.values) != terminal.runtime_size:
+		raise SnapshotError('Terminal has already been used')
+	state = _read(terminal, data, secret)
+	builder = terminal.builder.copy()
+	for name in state['names']:
+		builder.resolve_name(name)
+	if builder.version != state['version']:
+		raise SnapshotError('Snapshot does not match the global names')
+	scope = terminal.interpereter.root_scope
+	scope.values.extend(state['values'])
+	for index, protection in enumerate(state['security'], start=terminal.runtime_size):
+		if protection:
+			scope.set_security(index, protection)
+	terminal.builder = builder
+	terminal.line_count = state['line_count']
+
+
+def _read(terminal, data, secret):
+	template = terminal.runtime_template
+	if template is None:
+		raise SnapshotError('Terminal was not created from a runtime template')
+	key = snapshot_key(template)
+	if data[:len(MAGIC)] != MAGIC:
+		raise SnapshotError('Not a snapshot')
+	if data[len(MAGIC):len(MAGIC) + len(key)] != key:
+		raise SnapshotError('Snapshot is out of date')
+	signature = data[len(MAGIC) + len(key):len(MAGIC) + len(key) + 32]
+	state = data[len(MAGIC) + len(key) + 32:]
+	if not hmac.compare_digest(signature, sign(secret, key, state)):
+		raise SnapshotError('Snapshot has a bad signature')
+	try:
+		state = Unpickler(io.BytesIO(zlib.decompress(state)), terminal).load()
+	except SnapshotError:
+		raise
+	except Exception as e:
+		raise SnapshotError(f'Snapshot is damaged: {e}')
+	if not isinstance(state, dict) or set(state) != {'names', 'version', 'values', 'security', 'line_count'}:
+		raise SnapshotError('Snapshot is damaged')
+	return state
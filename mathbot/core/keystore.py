@@ -4,13 +4,18 @@
 
 
 import re
+import os
+import atexit
 import asyncio
 import collections
+import functools
 import json
 import aioredis
 import time
 import warnings
 import abc
+import bisect
+import traceback
 
 
 KEY_DELIMITER = ':'
@@ -18,10 +23,24 @@ KEY_DELIMITER = ':'
 
 class Driver(abc.ABC):
 
+	async def start(self):
+		''' Connects to the store ahead of time, rather than on first use '''
+
+	def stats(self):
+		''' Latency and error counts for each command '''
+		return {}
+
+	async def close(self):
+		''' Closes any connections to the store '''
+
 	@abc.abstractmethod
 	async def get(self, key: str):
 		pass
 
+	@abc.abstractmethod
+	async def mget(self, keys):
+		pass
+
 	@abc.abstractmethod
 	async def set(self, key: str, value):
 		pass
@@ -42,17 +61,85 @@ class Driver(abc.ABC):
 	async def rpop(self, key):
 		pass
 
+	@abc.abstractmethod
+	async def rpush(self, key, value, max_length=None, expire=None):
+		pass
+
+	@abc.abstractmethod
+	async def lrange(self, key, start, stop):
+		pass
+
+	@abc.abstractmethod
+	async def set_list(self, key, values, expire=None):
+		pass
+
+	@abc.abstractmethod
+	async def publish(self, channel, message):
+		pass
+
+	@abc.abstractmethod
+	async def subscribe(self, channel, callback):
+		pass
+
+
+class LatencyHistogram:
+
+	''' Counts how many times something took less than each of a set of durations '''
+
+	__slots__ = ['counts', 'total', 'errors']
+
+	# Upper bounds of the buckets, in seconds
+	BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf')]
+
+	def __init__(self):
+		self.counts = [0] * len(self.BOUNDS)
+		self.total = 0
+		self.errors = 0
+
+	def record(self, seconds):
+		self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+		self.total += seconds
+
+	def as_dict(self):
+		count = sum(self.counts)
+		return {
+			'count': count,
+			'errors': self.errors,
+			'mean': self.total / count if count else None,
+			'histogram': {
+				str(bound): n
+				for bound, n in zip(self.BOUNDS, self.counts)
+			}
+		}
+
 
 class Redis(Driver):
 
-	__slots__ = ['url', 'db_number', 'started', 'connection', 'startup_lock']
+	__slots__ = [
+		'url', 'db_number', 'started', 'connection', 'pubsub_connection', 'startup_lock',
+		'max_connections', 'socket_timeout', 'connect_timeout', 'retries', 'retry_backoff', 'latency'
+	]
 
-	def __init__(self, url, number = 0):
+	def __init__(self, url, number = 0, *, max_connections = None, socket_timeout = None,
+			connect_timeout = None, retries = 0, retry_backoff = 0.1):
 		self.url = url
 		self.db_number = number
 		self.started = False
 		self.connection = None
+		# Subscriptions have their own connection, since they
+		# can go for a long time without receiving anything
+		self.pubsub_connection = None
 		self.startup_lock = None
+		self.max_connections = max_connections
+		self.socket_timeout = socket_timeout
+		self.connect_timeout = connect_timeout
+		self.retries = retries
+		self.retry_backoff = retry_backoff
+		self.latency = collections.defaultdict(LatencyHistogram)
+
+	async def start(self):
+		await self.ensure_started()
+		await self.command('ping')
 
 	async def ensure_started(self):
 		# This is coroutine-atomic I'm pretty sure...
@@ -60,10 +147,59 @@ class Redis(Driver):
 			self.startup_lock = asyncio.Lock()
 		if not self.started:
 			async with self.startup_lock:
-					self.connection = await aioredis.from_url(self.url, encoding="utf-8", decode_responses=True)
+				if not self.started:
+					self.connection = await aioredis.from_url(
+						self.url,
+						encoding="utf-8",
+						decode_responses=True,
+						max_connections=self.max_connections,
+						socket_timeout=self.socket_timeout,
+						socket_connect_timeout=self.connect_timeout
+					)
 					self.started = True
 					print('Connected to redis server!')
 
+	async def command(self, name, *args, retry = True):
+		''' Runs a redis command, timing it and retrying it if the
+			connection fails. Commands that aren't safe to run twice
+			should pass retry=False.
+		'''
+		return await self.timed(name, lambda: getattr(self.connection, name)(*args), retry)
+
+	async def pipeline(self, name, *commands, retry = True):
+		''' Runs several commands as a transaction, in a single round trip.
+			Each command is a tuple of its name and arguments.
+		'''
+		async def execute():
+			async with self.connection.pipeline(transaction=True) as pipe:
+				for command, *args in commands:
+					getattr(pipe, command)(*args)
+				return await pipe.execute()
+		return await self.timed(name, execute, retry)
+
+	async def timed(self, name, function, retry):
+		await self.ensure_started()
+		histogram = self.latency[name]
+		attempt = 0
+		while True:
+			start = time.perf_counter()
+			try:
+				result = await function()
+			except Exception as e:
+				histogram.record(time.perf_counter() - start)
+				histogram.errors += 1
+				retryable = isinstance(e, (aioredis.ConnectionError, aioredis.TimeoutError))
+				if not (retry and retryable and attempt < self.retries):
+					raise
+			else:
+				histogram.record(time.perf_counter() - start)
+				return result
+			await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+			attempt += 1
+
+	def stats(self):
+		return {name: histogram.as_dict() for name, histogram in self.latency.items()}
+
 	@staticmethod
 	def decipher(value):
 		if value is None:
@@ -78,77 +214,379 @@ class Redis(Driver):
 		return value
 
 	async def get(self, key):
-		await self.ensure_started()
-		return self.decipher(await self.connection.get(key))
+		return self.decipher(await self.command('get', key))
+
+	async def mget(self, keys):
+		if not keys:
+			return []
+		return list(map(self.decipher, await self.command('mget', keys)))
 
 	async def set(self, key, value):
-		await self.ensure_started()
-		return await self.connection.set(key, value)
+		return await self.command('set', key, value)
 
 	async def delete(self, key):
-		await self.ensure_started()
-		return await self.connection.delete(key)
+		return await self.command('delete', key)
 
 	async def expire(self, key, time):
-		await self.ensure_started()
-		return await self.connection.expire(key, time)
+		return await self.command('expire', key, time)
 
 	async def lpush(self, key, value):
-		await self.ensure_started()
-		return await self.connection.lpush(key, value)
+		return await self.command('lpush', key, value, retry=False)
 
 	async def rpop(self, key):
-		await self.ensure_started()
-		return self.decipher(await self.connection.rpop(key))
+		return self.decipher(await self.command('rpop', key, retry=False))
 
 	async def llen(self, key):
+		return self.decipher(await self.command('llen', key))
+
+	async def rpush(self, key, value, max_length=None, expire=None):
+		commands = [('rpush', key, value)]
+		if max_length is not None:
+			commands.append(('ltrim', key, -max_length, -1))
+		if expire is not None:
+			commands.append(('expire', key, expire))
+		await self.pipeline('rpush', *commands, retry=False)
+
+	async def lrange(self, key, start, stop):
+		return await self.command('lrange', key, start, stop)
+
+	async def set_list(self, key, values, expire=None):
+		commands = [('delete', key)]
+		if values:
+			commands.append(('rpush', key, *values))
+			if expire is not None:
+				commands.append(('expire', key, expire))
+		await self.pipeline('set_list', *commands)
+
+	async def publish(self, channel, message):
+		return await self.command('publish', channel, message)
+
+	async def subscribe(self, channel, callback):
+		''' Calls the callback with each message sent to the channel.
+			If the connection is lost, the callback is called with None
+			once it's back, since messages may have been missed.
+		'''
 		await self.ensure_started()
-		return self.decipher(await self.connection.llen(key))
+		if self.pubsub_connection is None:
+			self.pubsub_connection = await aioredis.from_url(
+				self.url,
+				encoding="utf-8",
+				decode_responses=True,
+				socket_timeout=None,
+				socket_connect_timeout=self.connect_timeout
+			)
+		pubsub = self.pubsub_connection.pubsub()
+		await pubsub.subscribe(channel)
+		async def listen():
+			try:
+				while True:
+					try:
+						async for message in pubsub.listen():
+							if message['type'] == 'message':
+								callback(message['data'])
+					except aioredis.TimeoutError:
+						# Nothing was sent for a while, but the subscription is still there
+						continue
+					except Exception:
+						print(f'Lost subscription to {channel}, reconnecting')
+						traceback.print_exc()
+					await resubscribe()
+					callback(None)
+			finally:
+				# The task is cancelled when the bot closes
+				await pubsub.reset()
+		async def resubscribe():
+			nonlocal pubsub
+			while True:
+				await asyncio.sleep(5)
+				try:
+					# Gives the connection back to the pool, which
+					# doesn't happen when a PubSub is garbage collected
+					await pubsub.reset()
+				except Exception:
+					traceback.print_exc()
+				finally:
+					pubsub = self.pubsub_connection.pubsub()
+				try:
+					await pubsub.subscribe(channel)
+				except Exception:
+					traceback.print_exc()
+				else:
+					return
+		return asyncio.ensure_future(listen())
+
+	async def close(self):
+		for client in [self.connection, self.pubsub_connection]:
+			if client is not None:
+				await client.connection_pool.disconnect()
 
 
 class Disk(Driver):
 
-	__slots__ = ['filename', 'data']
+	''' Keeps everything in memory, and records changes in a log on disk.
+
+		The log is a file with a header line followed by JSON objects,
+		one per line, each describing a single change. Changes are written
+		(and fsynced) in batches, and the log is rewritten from scratch once
+		it has grown much larger than the data it describes. The file is
+		only read when the keystore is first used. While the event loop is
+		running, the file is written on another thread.
+	'''
+
+	__slots__ = [
+		'filename', 'data', 'loaded', 'pending', 'log_length',
+		'flush_interval', 'sweep_interval', 'flush_handle', 'flush_task', 'sweep_handle'
+	]
+
+	LOG_HEADER = '{"format": "keystore-log", "version": 1}'
+
+	# The log is compacted once it's this many times larger than the data
+	COMPACT_RATIO = 4
+	COMPACT_MINIMUM = 1000
 
-	def __init__(self, filename:str=None):
+	def __init__(self, filename:str=None, *, flush_interval=1, sweep_interval=60):
 		self.filename = filename
-		self.data = collections.defaultdict(
-			lambda : {
-				'value': None,
-				'expires': None
-			}
-		)
-		self.load()
+		self.data = {}
+		self.loaded = False
+		self.pending = []
+		# Number of changes in the log, or None if the file needs to be rewritten
+		self.log_length = None
+		self.flush_interval = flush_interval
+		self.sweep_interval = sweep_interval
+		self.flush_handle = None
+		self.flush_task = None
+		self.sweep_handle = None
+		if filename:
+			atexit.register(self.flush)
+
+	async def start(self):
+		# The sweep can only be scheduled once the event loop is running
+		self.ensure_loaded()
+		if self.sweep_handle is None:
+			self.sweep()
+
+	async def close(self):
+		if self.sweep_handle is not None:
+			self.sweep_handle.cancel()
+			self.sweep_handle = None
+		if self.flush_task is not None:
+			await self.flush_task
+		await self.flush_async()
+
+	def ensure_loaded(self):
+		if not self.loaded:
+			self.loaded = True
+			self.load()
+			self.sweep()
 
 	def load(self):
 		if self.filename:
 			try:
 				with open(self.filename) as f:
-					stored = json.load(f)
-					self.data.update(stored)
-					for key, value in self.data.items():
-						if isinstance(value['value'], list):
-							value['value'] = collections.deque(value['value'])
+					if f.readline().strip() == self.LOG_HEADER:
+						self.log_length = self.replay(f)
+					else:
+						# Older versions stored everything as a single JSON object
+						f.seek(0)
+						for key, value in json.load(f).items():
+							self.apply({'op': 'set', 'key': key, **value})
 			except FileNotFoundError:
 				pass
 
-	def save(self):
+	def replay(self, lines):
+		''' Applies the changes in a log, returning how many there were,
+			or None if the log was damaged.
+		'''
+		count = 0
+		for line in lines:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# Most likely a change that was being written when the bot stopped
+				print(f'Keystore log {self.filename} is damaged after {count} changes')
+				return None
+			self.apply(record)
+			count += 1
+		return count
+
+	def apply(self, record):
+		key = record['key']
+		op = record['op']
+		if op == 'set':
+			value = record['value']
+			if isinstance(value, list):
+				value = collections.deque(value)
+			self.data[key] = {
+				'value': value,
+				'expires': record.get('expires')
+			}
+		elif op == 'delete':
+			self.data.pop(key, None)
+		elif op == 'expire':
+			if key in self.data:
+				self.data[key]['expires'] = record['expires']
+		elif op == 'lpush':
+			self.get_list(key).appendleft(record['value'])
+		elif op == 'rpop':
+			self.get_list(key).pop()
+		elif op == 'rpush':
+			items = self.get_list(key)
+			items.append(record['value'])
+			max_length = record.get('max_length')
+			while max_length is not None and len(items) > max_length:
+				items.popleft()
+		else:
+			raise ValueError(f'Unknown keystore operation: {op}')
+
+	def change(self, record):
+		''' Makes a change and queues it to be written to the log '''
+		self.ensure_loaded()
+		self.apply(record)
 		if self.filename:
-			with open(self.filename, 'w') as f:
-				blob = {
-					key : {
-						'value': list(value['value']) if isinstance(value['value'], collections.deque) else value['value'],
-						'expires': value['expires']
-					}
-					for key, value in self.data.items()
-				}
-				json.dump(blob, f, indent = 4)
-
-	def is_expired(self, key):
-		if self.data[key]['expires'] is not None:
-			if self.data[key]['expires'] < time.time():
-				return True
-		return False
+			self.pending.append(json.dumps(record))
+			self.schedule_flush()
+
+	def schedule_flush(self):
+		if self.flush_handle is None:
+			try:
+				loop = asyncio.get_running_loop()
+			except RuntimeError:
+				self.flush()
+			else:
+				self.flush_handle = loop.call_later(self.flush_interval, self.start_flush)
+
+	def start_flush(self):
+		self.flush_handle = None
+		if self.flush_task is None or self.flush_task.done():
+			self.flush_task = asyncio.ensure_future(self.flush_async())
+		else:
+			# The last batch is still being written
+			self.schedule_flush()
+
+	def flush(self):
+		''' Writes all the queued changes to disk, blocking until it's done '''
+		if self.flush_handle is not None:
+			self.flush_handle.cancel()
+			self.flush_handle = None
+		job = self.prepare_flush()
+		if job is not None:
+			write, lines = job
+			try:
+				write()
+			except OSError:
+				self.flush_failed(lines)
+				raise
+
+	async def flush_async(self):
+		''' Writes all the queued changes to disk on another thread '''
+		if self.flush_handle is not None:
+			self.flush_handle.cancel()
+			self.flush_handle = None
+		job = self.prepare_flush()
+		if job is not None:
+			write, lines = job
+			try:
+				await asyncio.get_running_loop().run_in_executor(None, write)
+			except OSError:
+				traceback.print_exc()
+				self.flush_failed(lines)
+				self.schedule_flush()
+
+	def prepare_flush(self):
+		''' Takes the queued changes, and returns a function that writes them
+			to disk along with the changes themselves, or None if there's
+			nothing to write. The function doesn't look at the keystore,
+			so the keystore can carry on being used while it runs.
+		'''
+		if not self.pending:
+			return None
+		lines = self.pending
+		self.pending = []
+		if self.log_length is None or (
+			self.log_length + len(lines) > self.COMPACT_MINIMUM and
+			self.log_length + len(lines) > self.COMPACT_RATIO * len(self.data)
+		):
+			return self.prepare_compact(), lines
+		self.log_length += len(lines)
+		return functools.partial(self.append_log, self.filename, lines), lines
+
+	def flush_failed(self, lines):
+		# The changes are written again, and since some of them might
+		# have made it into the log, it's rewritten from scratch
+		self.pending[:0] = lines
+		self.log_length = None
+
+	def prepare_compact(self):
+		''' Returns a function that rewrites the log so that
+			it has a single change for each key
+		'''
+		for key in self.expired_keys():
+			del self.data[key]
+		entries = [
+			(key, list(entry['value']) if isinstance(entry['value'], collections.deque) else entry['value'], entry['expires'])
+			for key, entry in self.data.items()
+		]
+		self.log_length = len(entries)
+		return functools.partial(self.rewrite_log, self.filename, entries)
+
+	@staticmethod
+	def append_log(filename, lines):
+		with open(filename, 'a') as f:
+			f.write(''.join(line + '\n' for line in lines))
+			f.flush()
+			os.fsync(f.fileno())
+
+	@classmethod
+	def rewrite_log(cls, filename, entries):
+		lines = [cls.LOG_HEADER]
+		for key, value, expires in entries:
+			lines.append(json.dumps({
+				'op': 'set',
+				'key': key,
+				'value': value,
+				'expires': expires
+			}))
+		temporary = filename + '.tmp'
+		with open(temporary, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temporary, filename)
+
+	def sweep(self):
+		''' Removes expired keys, and does so again every so often '''
+		# Removals are logged so that replaying the log later on
+		# doesn't see a key that had already expired
+		for key in self.expired_keys():
+			self.change({'op': 'delete', 'key': key})
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			self.sweep_handle = None
+		else:
+			self.sweep_handle = loop.call_later(self.sweep_interval, self.sweep)
+
+	def expired_keys(self):
+		now = time.time()
+		return [key for key, entry in self.data.items() if entry['expires'] is not None and entry['expires'] < now]
+
+	def lookup(self, key):
+		''' Gets the entry for a key, or None if it doesn't exist or has expired '''
+		self.ensure_loaded()
+		entry = self.data.get(key)
+		if entry is not None and entry['expires'] is not None and entry['expires'] < time.time():
+			self.change({'op': 'delete', 'key': key})
+			return None
+		return entry
+
+	def get_list(self, key):
+		entry = self.data.get(key)
+		if entry is None or not isinstance(entry['value'], collections.deque):
+			entry = self.data[key] = {
+				'value': collections.deque(),
+				'expires': None
+			}
+		return entry['value']
 
 	@staticmethod
 	def decipher(value):
@@ -159,46 +597,71 @@ class Disk(Driver):
 		return value
 
 	async def get(self, key):
-		# if the key is expires, there is no value
-		if self.is_expired(key):
-			self.data[key]['value'] = None
-		return self.decipher(self.data[key]['value'])
+		entry = self.lookup(key)
+		return None if entry is None else self.decipher(entry['value'])
+
+	async def mget(self, keys):
+		return [await self.get(key) for key in keys]
 
 	async def set(self, key, value):
-		# If the key is expired, the new key has no expiery
-		if self.is_expired(key):
-			self.data[key]['value'] = None
-		self.data[key] = {
-			'value': value,
-			'expires': None
-		}
-		self.save()
+		self.change({'op': 'set', 'key': key, 'value': value})
 
 	async def delete(self, key):
-		if key in self.data:
-			del self.data[key]
+		if self.lookup(key) is not None:
+			self.change({'op': 'delete', 'key': key})
 
 	async def expire(self, key, seconds):
-		self.data[key]['expires'] = time.time() + seconds
-		self.save()
+		if self.lookup(key) is not None:
+			self.change({'op': 'expire', 'key': key, 'expires': time.time() + seconds})
 
 	async def lpush(self, key, value):
-		if not isinstance(self.data[key]['value'], collections.deque):
-			await self.set(key, collections.deque())
-		self.data[key]['value'].appendleft(value)
-		self.save()
+		self.lookup(key)
+		self.change({'op': 'lpush', 'key': key, 'value': value})
 
 	async def rpop(self, key):
-		if not isinstance(self.data[key]['value'], collections.deque):
-			await self.set(key, collections.deque())
-		if len(self.data[key]['value']) == 0:
+		entry = self.lookup(key)
+		if entry is None or not isinstance(entry['value'], collections.deque) or not entry['value']:
 			return None
-		return self.decipher(self.data[key]['value'].pop())
+		value = entry['value'][-1]
+		self.change({'op': 'rpop', 'key': key})
+		return self.decipher(value)
 
 	async def llen(self, key):
-		if not isinstance(self.data[key]['value'], collections.deque):
+		entry = self.lookup(key)
+		if entry is None or not isinstance(entry['value'], collections.deque):
 			return 0
-		return len(self.data[key]['value'])
+		return len(entry['value'])
+
+	async def rpush(self, key, value, max_length=None, expire=None):
+		self.lookup(key)
+		self.change({'op': 'rpush', 'key': key, 'value': value, 'max_length': max_length})
+		if expire is not None:
+			await self.expire(key, expire)
+
+	async def lrange(self, key, start, stop):
+		entry = self.lookup(key)
+		if entry is None or not isinstance(entry['value'], collections.deque):
+			return []
+		items = list(entry['value'])
+		# Same as redis, the stop index is inclusive
+		stop = len(items) if stop == -1 else stop + 1
+		return items[start:stop]
+
+	async def set_list(self, key, values, expire=None):
+		if not values:
+			await self.delete(key)
+		else:
+			self.change({'op': 'set', 'key': key, 'value': list(values)})
+			if expire is not None:
+				await self.expire(key, expire)
+
+	# Only one process uses the file, so there's nobody to talk to
+
+	async def publish(self, channel, message):
+		pass
+
+	async def subscribe(self, channel, callback):
+		pass
 
 
 class Interface:
@@ -213,6 +676,13 @@ class Interface:
 		key = reduce_key(keys)
 		return await self.driver.get(key)
 
+	async def mget(self, keys):
+		''' Gets several keys at once. Each key is given as a string or a tuple of parts. '''
+		return await self.driver.mget([
+			key if isinstance(key, str) else reduce_key(key)
+			for key in keys
+		])
+
 
 	# It's a bit strange how the end of this is the value
 	async def set(self, *args, expire = None):
@@ -263,9 +733,41 @@ class Interface:
 		key = reduce_key(keys)
 		return await self.driver.llen(key)
 
+	async def start(self):
+		await self.driver.start()
+
+	def stats(self):
+		return self.driver.stats()
+
+	async def rpush(self, *args, max_length = None, expire = None):
+		''' Adds a value to the end of a list, dropping items from the
+			start of the list if it becomes longer than max_length.
+		'''
+		key, value = reduce_key_val(args)
+		await self.driver.rpush(key, value, max_length, expire)
+
+	async def lrange(self, *keys, start = 0, stop = -1):
+		''' Gets the items of a list, from start to stop inclusive '''
+		key = reduce_key(keys)
+		return await self.driver.lrange(key, start, stop)
+
+	async def set_list(self, *args, expire = None):
+		''' Replaces the contents of a list '''
+		key, values = reduce_key_val(args)
+		await self.driver.set_list(key, values, expire)
+
+	async def publish(self, channel, message):
+		await self.driver.publish(channel, message)
+
+	async def subscribe(self, channel, callback):
+		return await self.driver.subscribe(channel, callback)
+
+	async def close(self):
+		await self.driver.close()
+
 
-def create_redis(url, number = 0):
-	return Interface(Redis(url, number))
+def create_redis(url, number = 0, **options):
+	return Interface(Redis(url, number, **options))
 
 
 def create_disk(filename):
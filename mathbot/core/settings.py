@@ -1,9 +1,12 @@
 from threading import Thread
+import asyncio
 import core.keystore
 import warnings
 import discord
 import discord.ext.commands
 
+from queuedict import QueueDict
+
 class None2:
 	pass
 
@@ -26,11 +29,42 @@ SETTINGS = {
 	'm-disabled-cmd': {'default': True}
 }
 
+# Settings that are actually stored, rather than redirecting to another one
+STORED_SETTINGS = [name for name, details in SETTINGS.items() if 'redirect' not in details]
+
+# Pub/sub channel used to tell other shards which keys have been changed
+INVALIDATION_CHANNEL = 'settings-invalidate'
+
 
 class Settings:
 
-	def __init__(self, keystore):
+	def __init__(self, keystore, *, cache_ttl=30, cache_size=100000, pubsub=False):
 		self.keystore = keystore
+		self.cache_ttl = cache_ttl
+		self.cache_size = cache_size
+		self.pubsub = pubsub
+		# Task that listens for changes made by other shards
+		self.invalidation_task = None
+		# Incremented whenever something is forgotten, so that values
+		# fetched before a change don't get put into the cache
+		self.generation = 0
+		self.forget_everything()
+
+	def forget_everything(self):
+		# Stored values of keys, including keys that have no value
+		self.cache = QueueDict(timeout=self.cache_ttl, max_size=self.cache_size)
+		self.generation += 1
+		self.forget_message_values()
+
+	def forget(self, key):
+		self.cache.pop(key)
+		self.generation += 1
+		self.forget_message_values()
+
+	def forget_message_values(self):
+		# Settings fetched for each message, so that everything
+		# that handles a message shares a single request.
+		self.message_values = QueueDict(timeout=60, max_size=1000)
 
 	def _get_key(self, setting, context):
 		setting = redirect(setting)
@@ -49,17 +83,62 @@ class Settings:
 		raise TypeError(f'Type ({type(context)}) {context.__class__} if not a valid settings context')
 
 	async def get_single(self, setting, context):
-		return await self.keystore.get(self._get_key(setting, context))
+		key = self._get_key(setting, context)
+		return (await self._get_values([key]))[key]
 
 	async def resolve(self, setting, *contexts, default=None2):
 		setting = redirect(setting)
-		for i in contexts:
-			result = await self.get_single(setting, i)
-			if result is not None:
-				return result
-		if default is not None2:
-			return default
-		return SETTINGS[setting]['default']
+		keys = [self._get_key(setting, i) for i in contexts]
+		values = await self._get_values(keys)
+		return _first_value(setting, keys, values, default)
+
+	async def _get_values(self, keys):
+		''' Gets the values of some keys, only going to the keystore for the
+			ones that aren't cached. Keys without a value are cached too,
+			since most settings are never changed.
+		'''
+		values = {}
+		missing = []
+		for key in keys:
+			value = self.cache.get(key, None2)
+			if value is None2:
+				missing.append(key)
+			else:
+				values[key] = value
+		if missing:
+			generation = self.generation
+			fetched = await self.keystore.mget(missing)
+			for key, value in zip(missing, fetched):
+				values[key] = value
+				if generation == self.generation:
+					self.cache[key] = value
+		return values
+
+	async def listen_for_invalidations(self):
+		''' Forget cached values when other shards change them '''
+		if self.pubsub:
+			self.invalidation_task = await self.keystore.subscribe(INVALIDATION_CHANNEL, self._on_invalidation)
+
+	async def close(self):
+		if self.invalidation_task is not None:
+			self.invalidation_task.cancel()
+			try:
+				await self.invalidation_task
+			except asyncio.CancelledError:
+				pass
+			self.invalidation_task = None
+
+	def _on_invalidation(self, key):
+		# None means that some messages might have been missed
+		if key is None:
+			self.forget_everything()
+		else:
+			self.forget(key)
+
+	async def _invalidate(self, key):
+		self.forget(key)
+		if self.pubsub:
+			await self.keystore.publish(INVALIDATION_CHANNEL, key)
 
 	async def resolve_message(self, setting, message: discord.Message):
 		setting = redirect(setting)
@@ -67,10 +146,41 @@ class Settings:
 			so = SETTINGS[setting]
 			return so.get('private', so['default'])
 		if isinstance(message.channel, discord.TextChannel):
-			return await self.resolve(setting, message.channel, message.channel.guild)
-		if hasattr(message, 'channel') and hasattr(message, 'guild'):
-			return await self.resolve(setting, message.channel, message.guild)
-		raise ValueError(f'{message} cannot be resolved for settings')
+			contexts = [message.channel, message.channel.guild]
+		elif hasattr(message, 'channel') and hasattr(message, 'guild'):
+			contexts = [message.channel, message.guild]
+		else:
+			raise ValueError(f'{message} cannot be resolved for settings')
+		keys = [self._get_key(setting, i) for i in contexts]
+		values = await self._get_message_values(message)
+		return _first_value(setting, keys, values, None2)
+
+	async def _get_message_values(self, message):
+		''' Gets every setting (and the prefix) that could apply to a message,
+			using a single request to the keystore. The result is remembered,
+			so later lookups for the same message don't make any requests.
+		'''
+		task = self.message_values.get(message.id)
+		if task is None:
+			task = asyncio.ensure_future(self._fetch_message_values(message))
+			self.message_values[message.id] = task
+		try:
+			# Shielded since other lookups for the message may be waiting on it too
+			return await asyncio.shield(task)
+		except Exception:
+			self.message_values.pop(message.id)
+			raise
+
+	async def _fetch_message_values(self, message):
+		keys = []
+		for context in [message.channel, message.guild]:
+			try:
+				keys += [self._get_key(setting, context) for setting in STORED_SETTINGS]
+			except TypeError:
+				# Not all channels can have settings
+				pass
+		keys.append(f's-prefix:{message.guild.id}')
+		return await self._get_values(keys)
 
 	async def set(self, setting, context, value):
 		setting = redirect(setting)
@@ -82,8 +192,13 @@ class Settings:
 			raise ValueError(f'{value} is not a valid setting value')
 		else:
 			await self.keystore.set(key, value)
+		await self._invalidate(key)
 
 	async def get_server_prefix(self, context):
+		if isinstance(context, discord.Message) and context.guild is not None:
+			values = await self._get_message_values(context)
+			stored = values[f's-prefix:{context.guild.id}']
+			return '=' if stored is None else stored
 		if isinstance(context, discord.Message):
 			context = context.channel
 		if isinstance(context, discord.DMChannel):
@@ -97,7 +212,8 @@ class Settings:
 			context = context.guild
 		if not isinstance(context, discord.Guild):
 			raise TypeError(f'{context} {type(context)} is not a valid context for the server prefix')
-		stored = await self.keystore.get(f's-prefix:{context.id}')
+		key = f's-prefix:{context.id}'
+		stored = (await self._get_values([key]))[key]
 		return '=' if stored is None else stored
 
 	async def set_server_prefix(self, context, prefix):
@@ -107,7 +223,22 @@ class Settings:
 			context = context.guild
 		if not isinstance(context, discord.Guild):
 			raise TypeError(f'{context} is not a valid guild.')
-		return (await self.keystore.set(f's-prefix:{context.id}', prefix)) or '='
+		key = f's-prefix:{context.id}'
+		result = await self.keystore.set(key, prefix)
+		await self._invalidate(key)
+		return result or '='
+
+
+def _first_value(setting, keys, values, default):
+	''' Finds the first of the keys that has a value, falling back to the default for the setting '''
+	for key in keys:
+		result = values.get(key)
+		if result is not None:
+			return result
+	if default is not None2:
+		return default
+	return SETTINGS[setting]['default']
+
 
 def _get_key(setting, context):
 	setting = redirect(setting)
@@ -0,0 +1,83 @@
+''' A single HTTP session that everything in the bot uses to talk
+	to other websites, so that connections (and DNS lookups) are
+	reused rather than being set up again for every request.
+'''
+
+import asyncio
+import aiohttp
+
+from core.keystore import LatencyHistogram
+
+
+class HostStats:
+
+	__slots__ = ['latency', 'statuses']
+
+	def __init__(self):
+		self.latency = LatencyHistogram()
+		# Number of responses in each class (2xx, 4xx etc)
+		self.statuses = {}
+
+	def as_dict(self):
+		return dict(self.latency.as_dict(), statuses=dict(self.statuses))
+
+
+class WebClient:
+
+	''' Owns the bot's aiohttp session, which is created the first time
+		it's used and lives until the bot shuts down. Request latency,
+		response codes and errors are counted for each host.
+	'''
+
+	__slots__ = ['limit', 'limit_per_host', 'keepalive_timeout', 'dns_cache_ttl', '_session', 'hosts']
+
+	def __init__(self, *, limit = 100, limit_per_host = 10, keepalive_timeout = 30, dns_cache_ttl = 300):
+		self.limit = limit
+		self.limit_per_host = limit_per_host
+		self.keepalive_timeout = keepalive_timeout
+		self.dns_cache_ttl = dns_cache_ttl
+		self._session = None
+		self.hosts = {}
+
+	@property
+	def session(self) -> aiohttp.ClientSession:
+		if self._session is None or self._session.closed:
+			connector = aiohttp.TCPConnector(
+				limit = self.limit,
+				limit_per_host = self.limit_per_host,
+				keepalive_timeout = self.keepalive_timeout,
+				ttl_dns_cache = self.dns_cache_ttl
+			)
+			trace = aiohttp.TraceConfig()
+			trace.on_request_start.append(self._on_request_start)
+			trace.on_request_end.append(self._on_request_end)
+			trace.on_request_exception.append(self._on_request_exception)
+			self._session = aiohttp.ClientSession(connector = connector, trace_configs = [trace])
+		return self._session
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+	def stats(self):
+		return {host: details.as_dict() for host, details in self.hosts.items()}
+
+	def _host(self, url):
+		host = url.host or '?'
+		details = self.hosts.get(host)
+		if details is None:
+			details = self.hosts[host] = HostStats()
+		return details
+
+	async def _on_request_start(self, session, context, params):
+		context.start = asyncio.get_running_loop().time()
+
+	async def _on_request_end(self, session, context, params):
+		details = self._host(params.url)
+		details.latency.record(asyncio.get_running_loop().time() - context.start)
+		status = f'{params.response.status // 100}xx'
+		details.statuses[status] = details.statuses.get(status, 0) + 1
+
+	async def _on_request_exception(self, session, context, params):
+		self._host(params.url).latency.errors += 1
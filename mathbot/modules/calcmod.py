@@ -8,6 +8,8 @@ import core.util
 import core.settings
 import calculator
 import calculator.blackbox
+import calculator.crucible
+import calculator.snapshot
 import collections
 import traceback
 import patrons
@@ -19,6 +21,10 @@ import traceback
 from typing import List
 import discord
 import abc
+import weakref
+import base64
+import hashlib
+import binascii
 
 from discord.ext.commands import command, guild_only, has_permissions, Cog, Context
 from discord.ext.commands.hybrid import hybrid_command
@@ -49,31 +55,135 @@ A support tier of **quadratic** or higher is required.
 '''
 
 
-SCOPES = dict()
-
-async def get_scope(place):
-	if place not in SCOPES:
-		SCOPES[place] = await calculator.blackbox.Terminal.new_blackbox(
-			retain_cache=False,
-			output_limit=1950,
-			yield_rate=1,
-			runtime_protection_level=2
-		)
-	return SCOPES[place]
-
-
-LOCKS = collections.defaultdict(asyncio.Lock)
+# Options for new calculator scopes. The calling cache limits
+# are filled in from the parameters when the module is loaded.
+SCOPE_OPTIONS = {
+	'retain_cache': False,
+	'output_limit': 1950,
+	'runtime_protection_level': 2
+}
 
 
 COMMAND_DELIM = '####'
 EXPIRE_TIME = 60 * 60 * 24 * 10 # Things expire in 10 days
+HISTORY_LENGTH = 2000 # Only the most recent commands are kept
+ACTIVE_CHANNELS_LENGTH = 5000 # Number of recently used channels that are remembered for warmup
+LIBRARY_CHECK_TIME = 60 * 5 # Cached libraries are used without checking for changes for 5 minutes
+# Requests to GitHub give up before the 10 second limit on the whole
+# download, so that the cached copy can be used instead.
+GIST_TIMEOUT = 8
 
 
 class ReplayState:
-	__slots__ = ['semaphore', 'loaded']
+	__slots__ = ['semaphore', 'loaded', 'libraries', 'recorded']
 	def __init__(self):
 		self.semaphore = asyncio.Semaphore()
 		self.loaded = False
+		# Whether the channel has been added to the list of active channels
+		self.recorded = False
+		# The libraries that were run when the channel was loaded (see library_versions)
+		self.libraries = []
+
+
+class ChannelScopes:
+
+	''' The calculator terminal for each channel, along with the lock that
+		stops two calculations running in a channel at once, and whether
+		the channel's libraries and history have been loaded.
+
+		Terminals that haven't been used for idle_timeout seconds are
+		dropped, as are the least recently used ones once there are more
+		than capacity of them or they're estimated to use more than
+		byte_budget bytes. A dropped channel is rebuilt from its snapshot,
+		or its libraries and history, the next time it's used.
+	'''
+
+	def __init__(self, *, capacity=None, idle_timeout=None, byte_budget=None):
+		self.capacity = capacity
+		self.idle_timeout = idle_timeout
+		self.byte_budget = byte_budget
+		# Least recently used first
+		self.terminals = collections.OrderedDict()
+		self.last_used = {}
+		self.replay_states = {}
+		# Locks are kept for as long as something is holding or waiting on them
+		self.locks = weakref.WeakValueDictionary()
+		# Channels that have changed since their snapshot was taken
+		self.dirty = {}
+		self.evictions = 0
+
+	def lock(self, place):
+		lock = self.locks.get(place)
+		if lock is None:
+			lock = self.locks[place] = asyncio.Lock()
+		return lock
+
+	def replay_state(self, place):
+		state = self.replay_states.get(place)
+		if state is None:
+			state = self.replay_states[place] = ReplayState()
+		return state
+
+	async def get(self, place):
+		terminal = self.terminals.get(place)
+		if terminal is None:
+			terminal = await calculator.blackbox.Terminal.new_blackbox(**SCOPE_OPTIONS)
+			self.terminals[place] = terminal
+			if self.capacity is not None and len(self.terminals) > self.capacity:
+				self.evict()
+		self.terminals.move_to_end(place)
+		self.last_used[place] = time.monotonic()
+		return terminal
+
+	def forget(self, place):
+		self.terminals.pop(place, None)
+		self.last_used.pop(place, None)
+		self.replay_states.pop(place, None)
+		self.dirty.pop(place, None)
+
+	def evict(self):
+		''' Drops terminals that have been idle for too long, or that don't
+			fit within the limits. Channels that are running something are
+			left alone. Returns the number of terminals that were dropped.
+		'''
+		now = time.monotonic()
+		candidates = [
+			place for place in self.terminals
+			if place not in self.locks or not self.locks[place].locked()
+		]
+		drop = set()
+		if self.idle_timeout is not None:
+			drop.update(place for place in candidates if now - self.last_used[place] > self.idle_timeout)
+		candidates = [place for place in candidates if place not in drop]
+		remaining = len(self.terminals) - len(drop)
+		if self.capacity is not None:
+			while remaining > self.capacity and candidates:
+				drop.add(candidates.pop(0))
+				remaining -= 1
+		if self.byte_budget is not None:
+			sizes = {place: terminal.estimate_size() for place, terminal in self.terminals.items() if place not in drop}
+			total = sum(sizes.values())
+			while total > self.byte_budget and candidates:
+				place = candidates.pop(0)
+				drop.add(place)
+				total -= sizes[place]
+		for place in drop:
+			self.forget(place)
+		self.evictions += len(drop)
+		return len(drop)
+
+	def stats(self):
+		return {
+			'terminals': len(self.terminals),
+			'dirty': len(self.dirty),
+			'evictions': self.evictions
+		}
+
+
+SCOPES = ChannelScopes()
+
+async def get_scope(place):
+	return await SCOPES.get(place)
 
 
 ENABLE_LIBS = True
@@ -86,12 +196,66 @@ HISTORY_ENABLED_SERVERS = []
 
 class CalculatorModule(Cog):
 
-	__slots__ = ['bot', 'command_history', 'replay_state']
+	__slots__ = ['bot', 'command_history', 'maintenance_task', 'warmup_task', 'snapshots_enabled', 'snapshot_max_size', 'snapshot_secret']
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.command_history = collections.defaultdict(lambda : '')
-		self.replay_state = collections.defaultdict(ReplayState)
+		self.maintenance_task = None
+		self.warmup_task = None
+		self.snapshots_enabled = bot.parameters.get('calculator snapshots enabled')
+		self.snapshot_max_size = bot.parameters.get('calculator snapshots max-size')
+		# Snapshots are signed so that the bot only loads ones that it made itself
+		secret = bot.parameters.get('calculator snapshots secret')
+		self.snapshot_secret = secret.encode('utf-8') if secret else None
+		if self.snapshots_enabled and self.snapshot_secret is None:
+			print('Calculator snapshots are disabled since no secret has been set')
+			self.snapshots_enabled = False
+		SCOPE_OPTIONS.update(
+			cache_capacity=bot.parameters.get('calculator calling-cache capacity'),
+			cache_byte_budget=bot.parameters.get('calculator calling-cache byte-budget'),
+			cache_item_size_limit=bot.parameters.get('calculator calling-cache item-size-limit')
+		)
+		SCOPES.capacity = bot.parameters.get('calculator scopes capacity')
+		SCOPES.idle_timeout = bot.parameters.get('calculator scopes idle-timeout')
+		SCOPES.byte_budget = bot.parameters.get('calculator scopes byte-budget')
+		calculator.crucible.GLOBAL_POOL.configure(
+			max_processes=bot.parameters.get('calculator crucible max-processes'),
+			min_idle=bot.parameters.get('calculator crucible min-idle'),
+			max_jobs=bot.parameters.get('calculator crucible max-jobs'),
+			max_memory=bot.parameters.get('calculator crucible max-memory'),
+			memory_limit=bot.parameters.get('calculator crucible memory-limit')
+		)
+
+	async def cog_load(self):
+		# Start the crucible processes now so that the first
+		# calculations don't have to wait for them.
+		calculator.crucible.GLOBAL_POOL.start()
+		self.maintenance_task = asyncio.ensure_future(self.maintain_scopes(60))
+		if self.bot.parameters.get('calculator warmup enabled'):
+			self.warmup_task = asyncio.ensure_future(self.warm_up(
+				self.bot.parameters.get('calculator warmup channels'),
+				self.bot.parameters.get('calculator warmup concurrency')
+			))
+
+	async def cog_unload(self):
+		if self.maintenance_task is not None:
+			self.maintenance_task.cancel()
+		if self.warmup_task is not None:
+			self.warmup_task.cancel()
+		await self.save_snapshots()
+
+	async def maintain_scopes(self, interval):
+		''' Saves snapshots of the channels that have changed, then drops unused scopes '''
+		while True:
+			await asyncio.sleep(interval)
+			try:
+				await self.save_snapshots()
+			except Exception:
+				traceback.print_exc()
+			dropped = SCOPES.evict()
+			if dropped:
+				print(f'Dropped {dropped} calculator scopes, {len(SCOPES.terminals)} remain')
 
 	@hybrid_command()
 	@core.settings.command_allowed('c-calc')
@@ -143,15 +307,14 @@ class CalculatorModule(Cog):
 				colour=discord.Colour.red()
 			)
 		# Download
-		async with aiohttp.ClientSession() as session:
-			lib_info = await download_library(session, url)
-			if isinstance(lib_info, LibraryDownloadIssue):
-				return discord.Embed(
-					title='Library load error',
-					description=str(lib_info),
-					colour=discord.Colour.red(),
-					url=lib_info.url
-				)
+		lib_info = await download_library(self.bot.keystore, self.bot.web.session, url)
+		if isinstance(lib_info, LibraryDownloadIssue):
+			return discord.Embed(
+				title='Library load error',
+				description=str(lib_info),
+				colour=discord.Colour.red(),
+				url=lib_info.url
+			)
 		# Get list of existing libraries
 		libs = await self.bot.keystore.get_json('calculator', 'libs', str(ctx.guild.id)) or []
 		# Ensure that the library is not already installed
@@ -205,11 +368,9 @@ class CalculatorModule(Cog):
 	@core.settings.command_allowed('c-calc')
 	async def handle_calc_reload(self, ctx):
 		channel = ctx.channel.id
-		async with LOCKS[channel]:
-			if channel in SCOPES:
-				del SCOPES[channel]
-			if channel in self.replay_state:
-				del self.replay_state[channel]
+		async with SCOPES.lock(channel):
+			SCOPES.forget(channel)
+			await self.bot.keystore.delete('calculator', 'snapshot', str(channel))
 		await ctx.send('Calculator state has been flushed from this channel.')
 
 	@Cog.listener()
@@ -230,8 +391,9 @@ class CalculatorModule(Cog):
 
 	# Perform a calculation and spits out a result!
 	async def perform_calculation(self, arg, message, send):
-		async with LOCKS[message.channel.id]:
+		async with SCOPES.lock(message.channel.id):
 			await self.ensure_loaded(message.channel, message.author)
+			await self.record_activity(message.channel)
 			# Yeah this is kinda not great...
 			arg = arg.strip('` \n\t')
 			if arg == '':
@@ -270,53 +432,212 @@ class CalculatorModule(Cog):
 						await self.add_command_to_history(message.channel, arg)
 				safe.sprint('Finished calculation:', arg)
 
-	async def ensure_loaded(self, channel, blame):
+	async def ensure_loaded(self, channel, blame, quiet = False):
 		# If command were previously run in this channel, re-run them
 		# in order to re-load any functions that were defined
 		# Ensure that only one coroutine is allowed to execute the code
 		# in this block at once.
-		async with self.replay_state[channel.id].semaphore:
-			if not self.replay_state[channel.id].loaded:
-				if ENABLE_LIBS and not utils.is_private(channel):
+		# A snapshot of the channel is used instead if there is one.
+		# If quiet is True, problems are logged instead of being sent to the channel.
+		replay_state = SCOPES.replay_state(channel.id)
+		async with replay_state.semaphore:
+			if not replay_state.loaded:
+				urls = await self.library_urls(channel)
+				downloaded = await download_libraries(self.bot.keystore, self.bot.web.session, urls)
+				replay_state.libraries = library_versions(downloaded)
+				history_allowed = ENABLE_HISTORY and await self.allow_calc_history(channel)
+				skip = None
+				if history_allowed:
+					commands = await self.unpack_commands(channel)
+					skip = await self.restore_snapshot(channel, replay_state.libraries, commands)
+				if skip is None and ENABLE_LIBS and not utils.is_private(channel):
 					print('Loading libraries for channel', channel)
-					await self.run_libraries(channel, channel.guild)
-				if ENABLE_HISTORY and await self.allow_calc_history(channel):
+					await self.run_libraries(channel, downloaded, quiet)
+				if history_allowed:
 					print('Replaying calculator commands for', channel)
-					await self.restore_history(channel, blame)
-				self.replay_state[channel.id].loaded = True
+					await self.restore_history(channel, blame, commands, skip or 0, quiet)
+				replay_state.loaded = True
+
+	async def report_problem(self, channel, quiet, embed):
+		if quiet:
+			print(f'{embed.title} ({channel})')
+		else:
+			await channel.send(embed=embed)
+
+	async def record_activity(self, channel):
+		''' Remembers that a channel has been used, so that
+			it can be warmed up when the bot next starts.
+		'''
+		replay_state = SCOPES.replay_state(channel.id)
+		if not replay_state.recorded:
+			replay_state.recorded = True
+			await self.bot.keystore.rpush(
+				'calculator', 'active-channels', str(channel.id),
+				max_length = ACTIVE_CHANNELS_LENGTH,
+				expire = EXPIRE_TIME
+			)
 
-	async def restore_history(self, channel, blame):
-		commands_unpacked = await self.unpack_commands(channel)
+	async def warm_up(self, max_channels, concurrency):
+		''' Loads the scopes of the channels that were used most recently,
+			so that the first calculation in each of them after a restart
+			doesn't have to wait for the libraries and history. Channels
+			that this shard can't see are skipped.
+		'''
+		await self.bot.wait_until_ready()
+		stored = await self.bot.keystore.lrange('calculator', 'active-channels')
+		# Most recently used first, without duplicates
+		places = list(dict.fromkeys(reversed(stored or [])))
+		channels = [
+			channel for channel in map(self.bot.get_channel, map(int, places))
+			if channel is not None
+		]
+		if SCOPES.capacity is not None:
+			max_channels = min(max_channels, SCOPES.capacity)
+		channels = channels[:max_channels]
+		print(f'Warming up {len(channels)} calculator scopes')
+		start = time.perf_counter()
+		semaphore = asyncio.Semaphore(concurrency)
+		finished = 0
+		failed = 0
+		async def warm(channel):
+			nonlocal finished, failed
+			async with semaphore:
+				try:
+					async with SCOPES.lock(channel.id):
+						await self.ensure_loaded(channel, None, quiet = True)
+				except Exception:
+					failed += 1
+					traceback.print_exc()
+				finished += 1
+				if finished % 10 == 0 or finished == len(channels):
+					print(f'Warmed up {finished}/{len(channels)} calculator scopes in {time.perf_counter() - start:.1f}s')
+		await asyncio.gather(*map(warm, channels))
+		print(f'Calculator warmup finished in {time.perf_counter() - start:.1f}s, {failed} failed')
+
+	async def restore_snapshot(self, channel, libraries, commands):
+		''' Loads the state of a channel from the snapshot that was taken
+			the last time it was used. Returns how many of the commands from
+			the history are already part of the snapshot, or None if there
+			isn't a usable snapshot, in which case nothing is changed.
+		'''
+		if not self.snapshots_enabled:
+			return None
+		stored = await self.bot.keystore.get_json('calculator', 'snapshot', str(channel.id))
+		if stored is None:
+			return None
+		skip = snapshot_position(stored, libraries, commands)
+		if skip is None:
+			print('Calculator snapshot is out of date for', channel)
+			return None
+		scope = await get_scope(channel.id)
+		try:
+			calculator.snapshot.load(scope, base64.b64decode(stored['data']), self.snapshot_secret)
+		except (calculator.snapshot.SnapshotError, binascii.Error) as e:
+			print(f'Could not restore calculator snapshot for {channel}: {e}')
+			return None
+		print('Restored calculator snapshot for', channel)
+		return skip
+
+	async def save_snapshots(self):
+		if not self.snapshots_enabled:
+			SCOPES.dirty.clear()
+			return
+		for place, channel in list(SCOPES.dirty.items()):
+			# Channels that are busy are saved next time around
+			if not SCOPES.lock(place).locked():
+				async with SCOPES.lock(place):
+					await self.save_snapshot(channel)
+
+	async def save_snapshot(self, channel):
+		''' Stores the state of a channel, along with the libraries and the
+			range of history that it came from. Channels whose state can't be
+			stored keep their previous snapshot, since it's still correct
+			once the newer commands are replayed on top of it.
+		'''
+		SCOPES.dirty.pop(channel.id, None)
+		scope = SCOPES.terminals.get(channel.id)
+		replay_state = SCOPES.replay_states.get(channel.id)
+		if scope is None or replay_state is None or not replay_state.loaded:
+			return
+		try:
+			data = calculator.snapshot.dump(scope, self.snapshot_secret)
+		except calculator.snapshot.SnapshotError as e:
+			print(f'Could not take calculator snapshot for {channel}: {e}')
+			return
+		if self.snapshot_max_size is not None and len(data) > self.snapshot_max_size:
+			print(f'Calculator snapshot for {channel} is too large ({len(data)} bytes)')
+			return
+		first = await self.bot.keystore.lrange('calculator', 'history-list', str(channel.id), start = 0, stop = 0)
+		last = await self.bot.keystore.lrange('calculator', 'history-list', str(channel.id), start = -1, stop = -1)
+		await self.bot.keystore.set_json('calculator', 'snapshot', str(channel.id), {
+			'data': base64.b64encode(data).decode('ascii'),
+			'libraries': replay_state.libraries,
+			'first': json.loads(first[0]) if first else None,
+			'last': json.loads(last[0]) if last else None
+		}, expire = EXPIRE_TIME)
+
+	async def restore_history(self, channel, blame, commands_unpacked, skip = 0, quiet = False):
+		''' Re-runs the commands from the history of a channel,
+			apart from the first skip of them, which have already been run.
+		'''
 		if not commands_unpacked:
 			print('No commands')
 		else:
-			was_error, commands_to_keep = await self.rerun_commands(channel, commands_unpacked)
+			was_error, commands_to_keep = await self.rerun_commands(channel, commands_unpacked[skip:])
+			commands_to_keep = commands_unpacked[:skip] + commands_to_keep
+			if skip < len(commands_unpacked):
+				SCOPES.dirty[channel.id] = channel
 			# Store the list of commands that worked back into storage for use next time
-			to_store = json.dumps(commands_to_keep)
-			await self.bot.keystore.set('calculator', 'history', str(channel.id), to_store, expire = EXPIRE_TIME)
+			if len(commands_to_keep) == len(commands_unpacked):
+				await self.bot.keystore.expire('calculator', 'history-list', str(channel.id), EXPIRE_TIME)
+			else:
+				to_store = list(map(json.dumps, commands_to_keep))
+				await self.bot.keystore.set_list('calculator', 'history-list', str(channel.id), to_store, expire = EXPIRE_TIME)
 			if was_error:
-				await channel.send(embed=discord.Embed(
+				await self.report_problem(channel, quiet, embed=discord.Embed(
 					title='Some errors occurred during catchup.',
 					description='Calculator state has been partially restored. Run `=calc-history` for a list of commands that have been retained.',
 					colour=discord.Colour.red()
 				))
 
 	async def unpack_commands(self, channel):
+		stored = await self.bot.keystore.lrange('calculator', 'history-list', str(channel.id))
+		if not stored:
+			return await self.migrate_commands(channel)
+		commands_unpacked = []
+		for command in stored:
+			try:
+				commands_unpacked.append(json.loads(command))
+			except json.JSONDecodeError:
+				print('JSON Decode failed when unpacking a command')
+		return commands_unpacked
+
+	async def migrate_commands(self, channel):
+		''' History used to be stored as a single JSON list, which
+			is moved into a keystore list the first time it's read.
+		'''
 		commands = await self.bot.keystore.get('calculator', 'history', str(channel.id))
 		if commands is None:
 			print('No commands to unpack')
 			return []
 		try:
 			commands_unpacked = json.loads(commands)
-			return commands_unpacked
 		except json.JSONDecodeError:
 			print('JSON Decode failed when unpacking commands')
 			return []
+		to_store = list(map(json.dumps, commands_unpacked[-HISTORY_LENGTH:]))
+		await self.bot.keystore.set_list('calculator', 'history-list', str(channel.id), to_store, expire = EXPIRE_TIME)
+		await self.bot.keystore.delete('calculator', 'history', str(channel.id))
+		return commands_unpacked[-HISTORY_LENGTH:]
+
+	async def library_urls(self, channel):
+		if not ENABLE_LIBS or utils.is_private(channel):
+			return []
+		libs = await self.bot.keystore.get_json('calculator', 'libs', str(channel.guild.id))
+		return [i['url'] for i in (libs or [])]
 
-	async def run_libraries(self, channel, guild):
+	async def run_libraries(self, channel, downloaded, quiet = False):
 		scope = await get_scope(channel.id)
-		libs = await self.bot.keystore.get_json('calculator', 'libs', str(guild.id))
-		downloaded = await download_libraries(i['url'] for i in (libs or []))
 		success = all(map(lambda r: isinstance(r, LibraryDownloadSuccess), downloaded))
 		if not downloaded:
 			print('No libraries')
@@ -324,7 +645,7 @@ class CalculatorModule(Cog):
 			for i in downloaded:
 				if isinstance(i, LibraryDownloadIssue):
 					# TODO: Blame message
-					await channel.send(
+					await self.report_problem(channel, quiet,
 						embed = discord.Embed(
 							title='Library load error',
 							description=str(i),
@@ -332,17 +653,18 @@ class CalculatorModule(Cog):
 							url=i.url
 						)
 					)
-					await asyncio.sleep(1.05)
+					if not quiet:
+						await asyncio.sleep(1.05)
 		else:
 			errors = []
 			for lib in downloaded:
 				print(f'library | {lib.url}')
-				result, worked, details = await scope.execute_async(lib.code)
+				result, worked, details = await scope.execute_async(lib.code, source_name=lib.url, cache_bytecode=True)
 				# print(result, worked)
 				if not worked:
 					errors.append(f'**Error in {lib.url}**\n```{result}```')
 			# TODO: Blame message
-			await channel.send(
+			await self.report_problem(channel, quiet,
 				embed = discord.Embed(
 					title='Errors occurred while running the libraries.',
 					description='Use `=calc-reload` to try again.\n' + '\n\n\n'.join(errors)[:2000],
@@ -370,13 +692,16 @@ class CalculatorModule(Cog):
 
 	async def add_command_to_history(self, channel, new_command):
 		if await self.allow_calc_history(channel):
-			history = await self.unpack_commands(channel)
-			history.append({
+			to_store = json.dumps({
 				'time': int(time.time()),
 				'expression': new_command
 			})
-			to_store = json.dumps(history)
-			await self.bot.keystore.set('calculator', 'history', str(channel.id), to_store, expire = EXPIRE_TIME)
+			await self.bot.keystore.rpush(
+				'calculator', 'history-list', str(channel.id), to_store,
+				max_length = HISTORY_LENGTH,
+				expire = EXPIRE_TIME
+			)
+			SCOPES.dirty[channel.id] = channel
 
 	async def allow_calc_history(self, channel):
 		if self.bot.parameters.get('release') == 'development':
@@ -403,6 +728,40 @@ def expression_has_side_effect(expr):
 	return any(map(expr.__contains__, ['=', '->', '~>', 'unload?']))
 
 
+def snapshot_position(stored, libraries, commands):
+	''' Works out how many of the commands from the history are included in
+		a snapshot, or returns None if it can't be used. Snapshots are only
+		used if they were taken with the same versions of the libraries, and
+		none of the commands that they include would be dropped by replaying
+		the history.
+	'''
+	if stored.get('libraries') != libraries:
+		return None
+	first = stored.get('first')
+	last = stored.get('last')
+	if last is None:
+		return 0
+	if not commands or commands[0] != first or first['time'] <= int(time.time()) - EXPIRE_TIME:
+		return None
+	for position in range(len(commands) - 1, -1, -1):
+		if commands[position] == last:
+			return position + 1
+	return None
+
+
+def library_versions(downloaded):
+	''' Identifies the code of each library, so that a snapshot taken
+		before a library was changed isn't used afterwards.
+	'''
+	return [
+		{
+			'url': lib.url,
+			'code': hashlib.sha256(lib.code.encode('utf-8')).hexdigest() if isinstance(lib, LibraryDownloadSuccess) else None
+		}
+		for lib in downloaded
+	]
+
+
 def history_grouping(commands):
 	current = []
 	current_size = 0
@@ -459,19 +818,17 @@ class LibraryDownloadError(Exception):
 		self.reason = reason
 
 
-async def download_libraries(urls: List[str]) -> List[LibraryDownloadResult]:
-	async with aiohttp.ClientSession() as session:
-		results = await asyncio.gather(*[
-			download_library(session, i) for i in urls
-		])
-	return results
+async def download_libraries(keystore, session: aiohttp.ClientSession, urls: List[str]) -> List[LibraryDownloadResult]:
+	return await asyncio.gather(*[
+		download_library(keystore, session, i) for i in urls
+	])
 
 
-async def download_library(session: aiohttp.ClientSession, url: str) -> LibraryDownloadResult:
+async def download_library(keystore, session: aiohttp.ClientSession, url: str) -> LibraryDownloadResult:
 	try:
 		async with async_timeout.timeout(10):
 			identifier = url.rsplit('/', 1)[1]
-			return await download_gist(session, url, identifier)
+			return await download_gist(keystore, session, url, identifier)
 	except LibraryDownloadError as e:
 		return LibraryDownloadIssue(url, e.reason)
 	except Exception as e:
@@ -479,45 +836,97 @@ async def download_library(session: aiohttp.ClientSession, url: str) -> LibraryD
 		return LibraryDownloadIssue(url, traceback.format_exc())
 
 
-async def download_gist(session: aiohttp.ClientSession, original_url: str, gist_id: str) -> LibraryDownloadResult:
-	url = f'https://api.github.com/gists/{gist_id}'
-	url_code = None
-	url_docs = None
-	async with session.get(url) as response:
-
-		if response.status == '404':
-			raise LibraryDownloadError('Library not found (server produced 404)')
-
-		response.raise_for_status()
-
-		blob = await response.json()
-		description = blob['description']
-
-		for filename, metadata in blob['files'].items():
-			fn = filename.lower()
-			if match_filename(fn, ('readme', 'help'), ('md', 'txt', 'rst')):
-				if url_docs is not None:
-					raise LibraryDownloadError('Found multiple documentation files. Requires exactly 1.')
-				url_docs = metadata['raw_url']
-			elif match_filename(fn, ('source',), ('',)):
-				if url_code is not None:
-					raise LibraryDownloadError('Found multiple code files. Requires exactly 1.')
-				url_code = metadata['raw_url']
+# Gists that are currently being fetched, so that guilds
+# loading the same library at once share the request.
+GIST_REQUESTS = {}
 
-	if url_code is None:
-		raise LibraryDownloadError('Gist had no code files')
-
-	code = await download_text(session, url_code)
-	docs = (await download_text(session, url_docs)) if url_docs is not None else ''
 
+async def download_gist(keystore, session: aiohttp.ClientSession, original_url: str, gist_id: str) -> LibraryDownloadResult:
+	task = GIST_REQUESTS.get(gist_id)
+	if task is None:
+		task = asyncio.ensure_future(fetch_gist(keystore, session, gist_id))
+		GIST_REQUESTS[gist_id] = task
+		task.add_done_callback(lambda _: GIST_REQUESTS.pop(gist_id, None))
+	# Shielded since other guilds may be waiting on the same request
+	details = await asyncio.shield(task)
 	return LibraryDownloadSuccess(
 		original_url,
-		description,
-		docs,
-		code
+		details['name'],
+		details['docs'],
+		details['code']
 	)
 
 
+async def fetch_gist(keystore, session: aiohttp.ClientSession, gist_id: str) -> dict:
+	''' Gets the contents of a gist. Gists are cached in the keystore along
+		with the ETag that GitHub gave for them, and are only downloaded again
+		once GitHub says that they have changed. The cached copy is used if
+		GitHub can't be reached.
+	'''
+	cached = await keystore.get_json('calculator', 'library', gist_id)
+	if cached is not None and time.time() - cached['checked'] < LIBRARY_CHECK_TIME:
+		return cached
+	url = f'https://api.github.com/gists/{gist_id}'
+	headers = {}
+	if cached is not None:
+		headers['If-None-Match'] = cached['etag']
+	url_code = None
+	url_docs = None
+	try:
+		# The whole download gets a deadline, as well as each request
+		async with async_timeout.timeout(GIST_TIMEOUT):
+			async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total = GIST_TIMEOUT)) as response:
+
+				if response.status == 304 and cached is not None:
+					cached['checked'] = int(time.time())
+					await keystore.set_json('calculator', 'library', gist_id, cached, expire = EXPIRE_TIME)
+					return cached
+
+				if response.status == 404:
+					raise LibraryDownloadError('Library not found (server produced 404)')
+
+				response.raise_for_status()
+
+				etag = response.headers.get('ETag')
+				blob = await response.json()
+				description = blob['description']
+				history = blob.get('history') or [{}]
+
+				for filename, metadata in blob['files'].items():
+					fn = filename.lower()
+					if match_filename(fn, ('readme', 'help'), ('md', 'txt', 'rst')):
+						if url_docs is not None:
+							raise LibraryDownloadError('Found multiple documentation files. Requires exactly 1.')
+						url_docs = metadata['raw_url']
+					elif match_filename(fn, ('source',), ('',)):
+						if url_code is not None:
+							raise LibraryDownloadError('Found multiple code files. Requires exactly 1.')
+						url_code = metadata['raw_url']
+
+			if url_code is None:
+				raise LibraryDownloadError('Gist had no code files')
+
+			code = await download_text(session, url_code)
+			docs = (await download_text(session, url_docs)) if url_docs is not None else ''
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		if cached is None:
+			raise
+		print(f'Using cached copy of gist {gist_id}: {e!r}')
+		return cached
+
+	details = {
+		'name': description,
+		'docs': docs,
+		'code': code,
+		'revision': history[0].get('version'),
+		'etag': etag,
+		'checked': int(time.time())
+	}
+	if etag is not None:
+		await keystore.set_json('calculator', 'library', gist_id, details, expire = EXPIRE_TIME)
+	return details
+
+
 def match_filename(specimen, allowed_names, allowed_exts):
 	specimen = specimen.lower()
 	assert all(map(lambda s: s == '' or s.islower(), allowed_names))
@@ -531,7 +940,7 @@ def match_filename(specimen, allowed_names, allowed_exts):
 
 
 async def download_text(session: aiohttp.ClientSession, url: str) -> str:
-	async with session.get(url) as response:
+	async with session.get(url, timeout=aiohttp.ClientTimeout(total = GIST_TIMEOUT)) as response:
 		data = await response.text()
 		if len(data) > 1000 * 32: # 32 KB
 			raise LibraryDownloadError('Downloaded file is too large (limit of 32,000 bytes)')
@@ -6,7 +6,6 @@ import json
 import urllib.parse
 import hmac
 import base64
-import aiohttp
 import io
 from open_relative import *
 from discord.ext.commands import Cog, Context
@@ -59,10 +58,6 @@ class LatexModule(Cog):
 		self.hmac_key = base64.urlsafe_b64decode(self.bot.parameters.get('latex hmac_key').encode() + b'==')
 		self.send_origin = self.bot.parameters.get('latex send_origin')
 		self.request_origin = self.bot.parameters.get('latex request_origin')
-		self.session = aiohttp.ClientSession()
-
-	async def cog_unload(self):
-		await self.session.close()
 
 	@hybrid_command(aliases=['latex', 'rtex', 'texw', 'wtex'])
 	@core.settings.command_allowed('c-tex')
@@ -102,7 +97,7 @@ class LatexModule(Cog):
 
 	async def render_slow(self, guard: MessageEditGuard, context: Context, request_url):
 		self.bot.loop.create_task(context.channel._state.http.send_typing(context.channel.id))
-		async with self.session.get(request_url, timeout=10) as response:
+		async with self.bot.web.session.get(request_url, timeout=10) as response:
 			if response.status != 200:
 				await guard.reply(context, get_latex_error_content(await response.text()))
 				return
@@ -112,7 +107,7 @@ class LatexModule(Cog):
 
 	async def render_fast(self, guard: MessageEditGuard, context: Context, send_url, request_url):
 		task = self.bot.loop.create_task(guard.reply(context, send_url))
-		async with self.session.get(request_url, timeout=10) as response:
+		async with self.bot.web.session.get(request_url, timeout=10) as response:
 			if response.status != 200:
 				content = await response.text()
 				message = await task
@@ -0,0 +1,60 @@
+# Reports the counters that the bot's services keep track of
+# (outbound HTTP requests, the keystore and the calculator), both as
+# a line in the log every so often and through a command that only
+# the bot's admin can use.
+
+import io
+import json
+import asyncio
+
+import discord
+from discord.ext.commands import command, Cog, Context
+
+import calculator.bytecode
+import calculator.crucible
+import modules.calcmod
+
+
+class StatsModule(Cog):
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.interval = bot.parameters.get('stats interval')
+		self.report_task = None
+
+	async def cog_load(self):
+		if self.interval:
+			self.report_task = asyncio.ensure_future(self.report_periodically())
+
+	async def cog_unload(self):
+		if self.report_task is not None:
+			self.report_task.cancel()
+
+	def collect(self):
+		return {
+			'http': self.bot.web.stats(),
+			'keystore': self.bot.keystore.stats(),
+			'calculator': {
+				'crucible': calculator.crucible.stats(),
+				'scopes': modules.calcmod.SCOPES.stats(),
+				'compile_cache': calculator.bytecode.COMPILE_CACHE.stats()
+			}
+		}
+
+	async def report_periodically(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			print('stats |', json.dumps(self.collect()))
+
+	@command()
+	async def stats(self, ctx: Context):
+		if ctx.author.id == self.bot.parameters.get('admin_id'):
+			text = json.dumps(self.collect(), indent = 4)
+			if len(text) < 1900:
+				await ctx.send(f'```json\n{text}\n```')
+			else:
+				await ctx.send(file = discord.File(io.BytesIO(text.encode('utf-8')), 'stats.json'))
+
+
+def setup(bot):
+	return bot.add_cog(StatsModule(bot))
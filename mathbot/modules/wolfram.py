@@ -296,7 +296,8 @@ class WolframModule(Cog):
 					assumptions,
 					imperial=(units == 'imperial'),
 					debug=debug,
-					extra_pod_information=not small
+					extra_pod_information=not small,
+					session=ctx.bot.web.session
 				)
 		except (wolfapi.WolframError, wolfapi.WolframDidntSucceed):
 			await ctx.send(ERROR_MESSAGE_NO_RESULTS)